@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from crowdsec_constants import APP_NAME, DEFAULT_SPLUNK_HOME
+
+logger = logging.getLogger("crowdsec_cache")
+
+DEFAULT_CACHE_TTL = 3600
+DEFAULT_CACHE_MAX_ENTRIES = 50000
+CACHE_FILENAME = "cti_verdicts.db"
+
+# sqlite caps the number of bound parameters per statement (999 on older builds)
+_SQLITE_MAX_PARAMS = 500
+
+
+def get_cache_local_path(cache_file=CACHE_FILENAME):
+    splunk_home = os.environ.get("SPLUNK_HOME", DEFAULT_SPLUNK_HOME)
+    app_path = os.path.join(splunk_home, "etc/apps", APP_NAME, "lookups/cache")
+    os.makedirs(app_path, exist_ok=True)
+    return os.path.join(app_path, cache_file)
+
+
+class VerdictCache:
+    """
+    Persistent cache of CTI smoke responses, keyed by IP.
+
+    Entries expire after `ttl` seconds. When the cache grows above
+    `max_entries`, expired entries are purged first, then the oldest ones.
+    IPs unknown to the CTI are stored as negative entries (None) so they are
+    not queried again until they expire.
+
+    The cache is best-effort: any sqlite error is logged and treated as a miss.
+    """
+
+    def __init__(
+        self, path, ttl=DEFAULT_CACHE_TTL, max_entries=DEFAULT_CACHE_MAX_ENTRIES
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # the connection is shared with the cssmoke worker threads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        try:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        except sqlite3.Error as exc:
+            logger.debug("Unable to enable WAL on %s: %s", path, exc)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts ("
+            "ip TEXT PRIMARY KEY, "
+            "payload TEXT, "
+            "stored_at REAL NOT NULL, "
+            "expires_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS verdicts_stored_at ON verdicts (stored_at)"
+        )
+
+    def get_many(self, ips):
+        """
+        Returns a dict {ip: entry} for the non-expired cached IPs.
+        Negative entries are returned with a None value.
+        """
+        ips = list(dict.fromkeys(ips))
+        now = time.time()
+        try:
+            with self._lock:
+                return self._select(ips, now)
+        except (sqlite3.Error, ValueError) as exc:
+            logger.debug("Verdict cache lookup failed: %s", exc)
+            return {}
+
+    def _select(self, ips, now):
+        found = {}
+        for i in range(0, len(ips), _SQLITE_MAX_PARAMS):
+            chunk = ips[i : i + _SQLITE_MAX_PARAMS]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._conn.execute(
+                f"SELECT ip, payload FROM verdicts "
+                f"WHERE ip IN ({placeholders}) AND expires_at > ?",
+                (*chunk, now),
+            )
+            for ip, payload in rows:
+                found[ip] = json.loads(payload) if payload is not None else None
+        return found
+
+    def set_many(self, entries):
+        """
+        Stores a dict {ip: entry} in the cache. A None entry is stored as a
+        negative entry.
+        """
+        if not entries:
+            return
+        now = time.time()
+        expires_at = now + self.ttl
+        rows = [
+            (ip, json.dumps(entry) if entry is not None else None, now, expires_at)
+            for ip, entry in entries.items()
+        ]
+        try:
+            with self._lock:
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO verdicts "
+                        "(ip, payload, stored_at, expires_at) VALUES (?, ?, ?, ?)",
+                        rows,
+                    )
+                self._evict(now)
+        except sqlite3.Error as exc:
+            logger.debug("Verdict cache store failed: %s", exc)
+
+    def _evict(self, now):
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()
+        if count <= self.max_entries:
+            return
+        with self._conn:
+            self._conn.execute("DELETE FROM verdicts WHERE expires_at <= ?", (now,))
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()
+            # evict a bit more than needed so we don't evict on every store
+            excess = count - int(self.max_entries * 0.9)
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM verdicts WHERE ip IN ("
+                    "SELECT ip FROM verdicts ORDER BY stored_at LIMIT ?)",
+                    (excess,),
+                )
+
+    def close(self):
+        try:
+            self._conn.close()
+        except sqlite3.Error:
+            pass
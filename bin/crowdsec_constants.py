@@ -8,6 +8,11 @@ CROWDSEC_API_BASE_URL = "https://cti.api.crowdsec.net"
 DUMP_TYPE_CROWDSEC = "crowdsec"
 DUMP_TYPE_GEOIP_ASN = "geoip_asn"
 
+# MMDB reader backends: "auto" uses the maxminddb C extension when available
+MMDB_BACKEND_AUTO = "auto"
+MMDB_BACKEND_NATIVE = "native"
+MMDB_BACKEND_PYTHON = "python"
+
 
 ## LOCAL DUMP CONFIGURATION
 LOCAL_DUMP_FILES = {
@@ -25,6 +30,12 @@ LOCAL_DUMP_FILES = {
     },
 }
 
+# Index merging the local dumps above, built after each download
+LOCAL_DUMP_MERGED_INDEX = "crowdsec_merged.idx"
+# Validators (ETag, Last-Modified, ...) of the local dumps above, to skip
+# downloading unchanged dumps
+LOCAL_DUMP_MANIFEST = "crowdsec_manifest.json"
+
 ## PROFILES CONFIGURATION
 BASE_PROFILE_FIELDS = [
     "ip",
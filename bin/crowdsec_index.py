@@ -0,0 +1,604 @@
+"""
+Sorted-interval index of a MMDB search tree.
+
+The search tree of a MMDB is walked once (after each download) and flattened
+into sorted arrays of network starts, data pointers and prefix lengths, one set
+for IPv4 and one for IPv6. Every leaf of the tree is stored, including empty
+networks, so the networks of an index cover the whole address space and a
+lookup is a single binary search instead of up to 128 node reads.
+
+The index file is memory-mapped at query time. Layout (native byte order):
+
+    header                         _HEADER (64 bytes)
+    IPv4 starts / pointers         n4 x uint32, n4 x uint32
+    IPv4 prefix lengths            n4 x uint8 (padded to 8 bytes)
+    IPv6 starts (high, low bits)   n6 x uint64, n6 x uint64
+    IPv6 pointers                  n6 x uint32
+    IPv6 prefix lengths            n6 x uint8
+
+The indexes of several databases can be merged into a single index holding one
+pointer per database for each network (see compile_merged_index), so that
+chained lookups cost a single search. Layout of a merged index:
+
+    header                         _MERGED_HEADER (40 bytes)
+    sources                        k x _MERGED_SOURCE (24 bytes)
+    IPv4 starts                    n4 x uint32
+    IPv4 pointers                  k x (n4 x uint32)
+    IPv4 prefix lengths            n4 x uint8
+    IPv6 starts (high, low bits)   n6 x uint64, n6 x uint64
+    IPv6 pointers                  k x (n6 x uint32)
+    IPv6 prefix lengths            n6 x uint8
+"""
+
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_right
+
+import maxminddb
+from maxminddb.const import MODE_MMAP
+
+logger = logging.getLogger("crowdsec_index")
+
+INDEX_SUFFIX = ".idx"
+
+_MAGIC = b"CSIDX001"
+_HEADER = struct.Struct("=8s8sQQQQQ16x")
+_BYTE_ORDER = sys.byteorder.encode().ljust(8, b"\x00")
+
+_MERGED_MAGIC = b"CSMRG001"
+_MERGED_HEADER = struct.Struct("=8s8sQQQ")
+_MERGED_SOURCE = struct.Struct("=QQQ")
+
+# Pointer stored for IPv6 networks aliased to the IPv4 subtree (e.g.
+# ::ffff:0:0/96 or 2002::/16): the lookup continues in the IPv4 index.
+ALIAS_POINTER = 0xFFFFFFFF
+
+_U32 = "I" if array("I").itemsize == 4 else "L"
+
+
+def get_index_path(mmdb_path):
+    return mmdb_path + INDEX_SUFFIX
+
+
+def _pad(size):
+    return -size % 8
+
+
+def _walk(reader, root, bit_count, alias_node=None):
+    """
+    Yields (network start, pointer, prefix length) for every leaf below `root`,
+    in address order. Empty networks have a 0 pointer.
+    """
+    node_count = reader._metadata.node_count
+    read_node = reader._read_node
+    stack = [(root, 0, 0)]
+    while stack:
+        node, depth, acc = stack.pop()
+        if node == alias_node and 0 < depth <= bit_count - 32:
+            yield acc << (bit_count - depth), ALIAS_POINTER, depth
+        elif node < node_count and depth < bit_count:
+            acc <<= 1
+            depth += 1
+            stack.append((read_node(node, 1), depth, acc | 1))
+            stack.append((read_node(node, 0), depth, acc))
+        elif node >= node_count:
+            pointer = node if node > node_count else 0
+            yield acc << (bit_count - depth), pointer, depth
+        else:
+            msg = "Invalid node in search tree"
+            raise maxminddb.InvalidDatabaseError(msg)
+
+
+def compile_index(mmdb_path, index_path=None):
+    """
+    Walks the search tree of `mmdb_path` and writes its interval index.
+    Returns (index path, IPv4 networks count, IPv6 networks count).
+    """
+    index_path = index_path or get_index_path(mmdb_path)
+    reader = maxminddb.open_database(mmdb_path, MODE_MMAP)
+    try:
+        metadata = reader.metadata()
+        v4_starts, v4_pointers, v4_prefixes = array(_U32), array(_U32), array("B")
+        v6_high, v6_low = array("Q"), array("Q")
+        v6_pointers, v6_prefixes = array(_U32), array("B")
+
+        ipv4_start = reader._ipv4_start
+        if metadata.ip_version == 6 and ipv4_start >= metadata.node_count:
+            # the tree has no IPv4 subtree: ::/96 is a single network
+            v4_starts.append(0)
+            v4_pointers.append(ipv4_start if ipv4_start > metadata.node_count else 0)
+            v4_prefixes.append(0)
+        else:
+            for start, pointer, prefix_len in _walk(reader, ipv4_start, 32):
+                v4_starts.append(start)
+                v4_pointers.append(pointer)
+                v4_prefixes.append(prefix_len)
+
+        if metadata.ip_version == 6:
+            alias_node = ipv4_start if ipv4_start < metadata.node_count else None
+            for start, pointer, prefix_len in _walk(reader, 0, 128, alias_node):
+                v6_high.append(start >> 64)
+                v6_low.append(start & 0xFFFFFFFFFFFFFFFF)
+                v6_pointers.append(pointer)
+                v6_prefixes.append(prefix_len)
+
+        header = _HEADER.pack(
+            _MAGIC,
+            _BYTE_ORDER,
+            os.path.getsize(mmdb_path),
+            metadata.build_epoch,
+            metadata.node_count,
+            len(v4_starts),
+            len(v6_pointers),
+        )
+    finally:
+        reader.close()
+
+    _write_index(
+        index_path,
+        header,
+        (
+            v4_starts,
+            v4_pointers,
+            v4_prefixes,
+            v6_high,
+            v6_low,
+            v6_pointers,
+            v6_prefixes,
+        ),
+    )
+    return index_path, len(v4_starts), len(v6_pointers)
+
+
+def _write_index(index_path, header, sections):
+    """Writes an index file atomically, each section padded to 8 bytes"""
+    index_dir = os.path.dirname(index_path)
+    fd, tmp_path = tempfile.mkstemp(prefix=".idx_tmp_", dir=index_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(b"\x00" * _pad(len(header)))
+            for section in sections:
+                data = section.tobytes()
+                f.write(data)
+                f.write(b"\x00" * _pad(len(data)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, index_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _v4_leaves(index):
+    return zip(index._v4_starts, index._v4_pointers, index._v4_prefixes)
+
+
+def _v6_leaves(index, shared_aliases):
+    """
+    Yields the IPv6 leaves of an index in address order. The networks aliased
+    to the IPv4 subtree are kept as is when they are in `shared_aliases`, else
+    they are expanded into the IPv4 leaves they alias.
+    """
+    if not len(index._v6_high):
+        # IPv4-only database: IPv6 lookups find nothing
+        yield 0, 0, 0
+        return
+    for high, low, pointer, prefix_len in zip(
+        index._v6_high, index._v6_low, index._v6_pointers, index._v6_prefixes
+    ):
+        start = high << 64 | low
+        if pointer != ALIAS_POINTER or (start, prefix_len) in shared_aliases:
+            yield start, pointer, prefix_len
+            continue
+        for v4_start, v4_pointer, v4_prefix_len in _v4_leaves(index):
+            yield (
+                start | v4_start << (96 - prefix_len),
+                v4_pointer,
+                prefix_len + v4_prefix_len,
+            )
+
+
+def _intersect(streams, bit_count):
+    """
+    Yields (start, pointers, prefix lengths) for each intersection of the
+    leaves of several streams, each of them covering the whole address space.
+    """
+    current = [next(stream) for stream in streams]
+    ends = [start + (1 << (bit_count - prefix_len)) for start, _, prefix_len in current]
+    position = 0
+    limit = 1 << bit_count
+    while position < limit:
+        yield (
+            position,
+            tuple(leaf[1] for leaf in current),
+            tuple(leaf[2] for leaf in current),
+        )
+        position = min(ends)
+        if position == limit:
+            return
+        for i, end in enumerate(ends):
+            if end == position:
+                current[i] = leaf = next(streams[i])
+                ends[i] = leaf[0] + (1 << (bit_count - leaf[2]))
+
+
+def _merge(intersections, bit_count, stops):
+    """
+    Yields (start, pointers, prefix length) for the merged networks.
+
+    Sources are consulted in order until a record satisfies the stop function
+    of its source: the pointers of the following sources are cleared, and the
+    intersections belonging to the same network of the consulted sources are
+    coalesced. The prefix length is the one of the most specific network of
+    the consulted sources.
+    """
+    count = len(stops)
+    last = None
+    for start, pointers, prefix_lens in intersections:
+        if pointers[0] == ALIAS_POINTER:
+            last = None
+            yield start, pointers, prefix_lens[0]
+            continue
+        prefix_len = 0
+        for i in range(count):
+            prefix_len = max(prefix_len, prefix_lens[i])
+            if pointers[i] and stops[i](pointers[i]):
+                pointers = pointers[: i + 1] + (0,) * (count - i - 1)
+                break
+        network = (start >> (bit_count - prefix_len), prefix_len, pointers)
+        if network == last:
+            continue
+        last = network
+        yield start, pointers, prefix_len
+
+
+def compile_merged_index(sources, index_path):
+    """
+    Merges the interval indexes of several MMDBs into a single index.
+
+    `sources` is a list of (mmdb path, stop) in priority order, where
+    stop(record) is True when the lower priority databases need not be
+    consulted for the networks of that record (the record is decoded lazily).
+    The interval index of each MMDB must be up to date.
+    Returns (index path, IPv4 networks count, IPv6 networks count).
+    """
+    readers = []
+    indexes = []
+    try:
+        for mmdb_path, _ in sources:
+            reader = maxminddb.open_database(mmdb_path, MODE_MMAP)
+            readers.append(reader)
+            index = IntervalIndex(get_index_path(mmdb_path))
+            indexes.append(index)
+            if not index.matches(reader, mmdb_path):
+                raise ValueError(f"the index of {mmdb_path} is outdated")
+
+        stops = []
+        for reader, (_, stop) in zip(readers, sources):
+            stops.append(_memoized_stop(reader, stop))
+
+        count = len(sources)
+        v4_starts, v4_prefixes = array(_U32), array("B")
+        v4_pointers = [array(_U32) for _ in range(count)]
+        for start, pointers, prefix_len in _merge(
+            _intersect([_v4_leaves(index) for index in indexes], 32), 32, stops
+        ):
+            v4_starts.append(start)
+            for column, pointer in zip(v4_pointers, pointers):
+                column.append(pointer)
+            v4_prefixes.append(prefix_len)
+
+        aliases = [
+            {
+                (high << 64 | low, prefix_len)
+                for high, low, pointer, prefix_len in zip(
+                    index._v6_high,
+                    index._v6_low,
+                    index._v6_pointers,
+                    index._v6_prefixes,
+                )
+                if pointer == ALIAS_POINTER
+            }
+            for index in indexes
+        ]
+        shared_aliases = set.intersection(*aliases)
+        v6_high, v6_low, v6_prefixes = array("Q"), array("Q"), array("B")
+        v6_pointers = [array(_U32) for _ in range(count)]
+        if any(len(index._v6_high) for index in indexes):
+            for start, pointers, prefix_len in _merge(
+                _intersect(
+                    [_v6_leaves(index, shared_aliases) for index in indexes], 128
+                ),
+                128,
+                stops,
+            ):
+                v6_high.append(start >> 64)
+                v6_low.append(start & 0xFFFFFFFFFFFFFFFF)
+                for column, pointer in zip(v6_pointers, pointers):
+                    column.append(pointer)
+                v6_prefixes.append(prefix_len)
+
+        header = _MERGED_HEADER.pack(
+            _MERGED_MAGIC, _BYTE_ORDER, count, len(v4_starts), len(v6_high)
+        ) + b"".join(
+            _MERGED_SOURCE.pack(
+                index.source_size, index.build_epoch, index.node_count
+            )
+            for index in indexes
+        )
+    finally:
+        for index in indexes:
+            index.close()
+        for reader in readers:
+            reader.close()
+
+    _write_index(
+        index_path,
+        header,
+        (
+            v4_starts,
+            *v4_pointers,
+            v4_prefixes,
+            v6_high,
+            v6_low,
+            *v6_pointers,
+            v6_prefixes,
+        ),
+    )
+    return index_path, len(v4_starts), len(v6_high)
+
+
+def _memoized_stop(reader, stop):
+    results = {}
+
+    def memoized(pointer):
+        result = results.get(pointer)
+        if result is None:
+            result = results[pointer] = bool(
+                stop(reader._resolve_data_pointer(pointer, True))
+            )
+        return result
+
+    return memoized
+
+
+class IntervalIndex:
+    """Memory-mapped interval index, see compile_index."""
+
+    def __init__(self, index_path):
+        with open(index_path, "rb") as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            (
+                magic,
+                byte_order,
+                self.source_size,
+                self.build_epoch,
+                self.node_count,
+                n4,
+                n6,
+            ) = _HEADER.unpack_from(self._buffer, 0)
+            if magic != _MAGIC or byte_order != _BYTE_ORDER:
+                raise ValueError(f"{index_path} is not a valid index for this host")
+
+            view = memoryview(self._buffer)
+            offset = _HEADER.size
+
+            def section(typecode, count, itemsize):
+                nonlocal offset
+                size = count * itemsize
+                values = view[offset : offset + size].cast(typecode)
+                offset += size + _pad(size)
+                return values
+
+            self._v4_starts = section(_U32, n4, 4)
+            self._v4_pointers = section(_U32, n4, 4)
+            self._v4_prefixes = section("B", n4, 1)
+            self._v6_high = section("Q", n6, 8)
+            self._v6_low = section("Q", n6, 8)
+            self._v6_pointers = section(_U32, n6, 4)
+            self._v6_prefixes = section("B", n6, 1)
+            if offset > len(self._buffer) or not n4:
+                raise ValueError(f"{index_path} is truncated")
+        except Exception:
+            self.close()
+            raise
+
+    def matches(self, reader, mmdb_path):
+        """True if the index was compiled from the database opened by `reader`"""
+        metadata = reader.metadata()
+        return (
+            self.build_epoch == metadata.build_epoch
+            and self.node_count == metadata.node_count
+            and self.source_size == os.path.getsize(mmdb_path)
+        )
+
+    def lookup(self, version, ip_int):
+        """Returns (pointer, prefix length) of the network containing the IP"""
+        if version == 4:
+            i = bisect_right(self._v4_starts, ip_int) - 1
+            return self._v4_pointers[i], self._v4_prefixes[i]
+
+        i = self._bisect_v6(ip_int, 0) - 1
+        return self._resolve_v6(ip_int, i)
+
+    def lookup_many(self, version, ip_ints):
+        """
+        Same as lookup for a list of IPs sorted in ascending order: each search
+        starts from the network matched by the previous IP.
+        """
+        results = []
+        i = 0
+        if version == 4:
+            starts = self._v4_starts
+            pointers = self._v4_pointers
+            prefixes = self._v4_prefixes
+            for ip_int in ip_ints:
+                i = bisect_right(starts, ip_int, i) - 1
+                results.append((pointers[i], prefixes[i]))
+            return results
+
+        for ip_int in ip_ints:
+            i = self._bisect_v6(ip_int, i) - 1
+            results.append(self._resolve_v6(ip_int, i))
+        return results
+
+    def _bisect_v6(self, ip_int, lo):
+        high = ip_int >> 64
+        low = ip_int & 0xFFFFFFFFFFFFFFFF
+        v6_high = self._v6_high
+        v6_low = self._v6_low
+        hi = len(v6_high)
+        if not hi:
+            raise ValueError("IPv6 lookup in an IPv4-only index")
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_high = v6_high[mid]
+            if high < mid_high or (high == mid_high and low < v6_low[mid]):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _resolve_v6(self, ip_int, i):
+        pointer = self._v6_pointers[i]
+        prefix_len = self._v6_prefixes[i]
+        if pointer == ALIAS_POINTER:
+            v4_int = (ip_int >> (96 - prefix_len)) & 0xFFFFFFFF
+            pointer, v4_prefix_len = self.lookup(4, v4_int)
+            return pointer, prefix_len + v4_prefix_len
+        return pointer, prefix_len
+
+    def close(self):
+        for name in (
+            "_v4_starts",
+            "_v4_pointers",
+            "_v4_prefixes",
+            "_v6_high",
+            "_v6_low",
+            "_v6_pointers",
+            "_v6_prefixes",
+        ):
+            values = self.__dict__.pop(name, None)
+            if isinstance(values, list):
+                for column in values:
+                    column.release()
+            elif values is not None:
+                values.release()
+        self._buffer.close()
+
+
+class MergedIndex(IntervalIndex):
+    """
+    Memory-mapped merged index, see compile_merged_index. Lookups return a
+    tuple of pointers, one per source database (0 when the network is empty
+    or the database need not be consulted).
+    """
+
+    def __init__(self, index_path):
+        with open(index_path, "rb") as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, byte_order, count, n4, n6 = _MERGED_HEADER.unpack_from(
+                self._buffer, 0
+            )
+            if magic != _MERGED_MAGIC or byte_order != _BYTE_ORDER:
+                raise ValueError(
+                    f"{index_path} is not a valid merged index for this host"
+                )
+            offset = _MERGED_HEADER.size
+            self.sources = []
+            for _ in range(count):
+                self.sources.append(_MERGED_SOURCE.unpack_from(self._buffer, offset))
+                offset += _MERGED_SOURCE.size
+            offset += _pad(offset)
+
+            view = memoryview(self._buffer)
+
+            def section(typecode, count, itemsize):
+                nonlocal offset
+                size = count * itemsize
+                values = view[offset : offset + size].cast(typecode)
+                offset += size + _pad(size)
+                return values
+
+            self._v4_starts = section(_U32, n4, 4)
+            self._v4_pointers = [section(_U32, n4, 4) for _ in range(count)]
+            self._v4_prefixes = section("B", n4, 1)
+            self._v6_high = section("Q", n6, 8)
+            self._v6_low = section("Q", n6, 8)
+            self._v6_pointers = [section(_U32, n6, 4) for _ in range(count)]
+            self._v6_prefixes = section("B", n6, 1)
+            if offset > len(self._buffer) or not n4 or not count:
+                raise ValueError(f"{index_path} is truncated")
+        except Exception:
+            self.close()
+            raise
+
+    def matches(self, sources):
+        """
+        True if the index was merged from the databases of `sources`, a list
+        of (maxminddb reader, mmdb path) in priority order
+        """
+        if len(sources) != len(self.sources):
+            return False
+        for (reader, mmdb_path), (size, build_epoch, node_count) in zip(
+            sources, self.sources
+        ):
+            metadata = reader.metadata()
+            if (
+                build_epoch != metadata.build_epoch
+                or node_count != metadata.node_count
+                or size != os.path.getsize(mmdb_path)
+            ):
+                return False
+        return True
+
+    def lookup(self, version, ip_int):
+        """Returns (pointers, prefix length) of the network containing the IP"""
+        if version == 4:
+            i = bisect_right(self._v4_starts, ip_int) - 1
+            return (
+                tuple([column[i] for column in self._v4_pointers]),
+                self._v4_prefixes[i],
+            )
+
+        i = self._bisect_v6(ip_int, 0) - 1
+        return self._resolve_v6(ip_int, i)
+
+    def lookup_many(self, version, ip_ints):
+        """
+        Same as lookup for a list of IPs sorted in ascending order: each search
+        starts from the network matched by the previous IP.
+        """
+        results = []
+        i = 0
+        if version == 4:
+            starts = self._v4_starts
+            columns = self._v4_pointers
+            prefixes = self._v4_prefixes
+            for ip_int in ip_ints:
+                i = bisect_right(starts, ip_int, i) - 1
+                results.append((tuple([column[i] for column in columns]), prefixes[i]))
+            return results
+
+        for ip_int in ip_ints:
+            i = self._bisect_v6(ip_int, i) - 1
+            results.append(self._resolve_v6(ip_int, i))
+        return results
+
+    def _resolve_v6(self, ip_int, i):
+        prefix_len = self._v6_prefixes[i]
+        if self._v6_pointers[0][i] == ALIAS_POINTER:
+            v4_int = (ip_int >> (96 - prefix_len)) & 0xFFFFFFFF
+            pointers, v4_prefix_len = self.lookup(4, v4_int)
+            return pointers, prefix_len + v4_prefix_len
+        return tuple([column[i] for column in self._v6_pointers]), prefix_len
@@ -0,0 +1,44 @@
+import socket
+from ipaddress import IPv4Address, IPv6Address
+
+_AF_INET = socket.AF_INET
+_AF_INET6 = socket.AF_INET6
+_inet_pton = socket.inet_pton
+
+# "1.1.1.1" to "255.255.255.255"
+_IPV4_MIN_LEN = 7
+_IPV4_MAX_LEN = 15
+# "0000:0000:0000:0000:0000:ffff:255.255.255.255" without a scope
+_IPV6_MAX_LEN = 45
+
+
+def parse_ip(ip):
+    """
+    Returns (ip version, ip int) for an IP address string or ipaddress object,
+    or None if the IP address is not valid.
+
+    Strings are parsed with inet_pton rather than ipaddress, and values that
+    cannot be an IP address (empty strings, hostnames, ...) are rejected
+    before trying to parse them.
+    """
+    if type(ip) is not str:
+        if isinstance(ip, (IPv4Address, IPv6Address)):
+            return ip.version, int(ip)
+        return None
+
+    if ":" in ip:
+        # the scope of link-local addresses (e.g. fe80::1%eth0) is ignored
+        address = ip.split("%", 1)[0] if "%" in ip else ip
+        if len(address) > _IPV6_MAX_LEN:
+            return None
+        try:
+            return 6, int.from_bytes(_inet_pton(_AF_INET6, address), "big")
+        except OSError:
+            return None
+
+    if not _IPV4_MIN_LEN <= len(ip) <= _IPV4_MAX_LEN or not ip[0].isdigit():
+        return None
+    try:
+        return 4, int.from_bytes(_inet_pton(_AF_INET, ip), "big")
+    except OSError:
+        return None
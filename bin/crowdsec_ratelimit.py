@@ -0,0 +1,127 @@
+import email.utils
+import random
+import threading
+import time
+
+DEFAULT_RATE_LIMIT = 0
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BUDGET = 60
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+
+
+class TokenBucket:
+    """
+    Thread-safe client-side rate limiter.
+
+    `rate` tokens are added per second, up to `capacity`. A rate <= 0 disables
+    throttling, but the bucket still honours pauses requested with `pause`
+    (e.g. from a Retry-After header).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(self.rate, 1.0))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        """Blocks every caller of `acquire` for the next `seconds`."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self.rate <= 0:
+                    return
+                else:
+                    elapsed = now - self._updated
+                    self._tokens = min(
+                        self.capacity, self._tokens + elapsed * self.rate
+                    )
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class RetryBudget:
+    """Total number of seconds that can be spent waiting between retries."""
+
+    def __init__(self, seconds):
+        self._remaining = float(seconds)
+        self._lock = threading.Lock()
+
+    def consume(self, seconds):
+        with self._lock:
+            if seconds > self._remaining:
+                return False
+            self._remaining -= seconds
+            return True
+
+
+def parse_retry_after(value):
+    """Parses a Retry-After header (delay in seconds or HTTP-date) into seconds."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+def get_retry_delay(response, attempt):
+    """
+    Returns (delay, from_server): the server-provided delay when the response
+    has a Retry-After header, a jittered exponential backoff otherwise.
+    """
+    headers = getattr(response, "headers", None) or {}
+    delay = parse_retry_after(headers.get("Retry-After"))
+    if delay is not None:
+        return delay, True
+
+    backoff = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2**attempt))
+    return backoff / 2 + random.uniform(0, backoff / 2), False
+
+
+def send_with_retry(send, limiter, budget, max_retries=DEFAULT_MAX_RETRIES):
+    """
+    Calls `send()` once a token is available, retrying on 429/5xx responses
+    until `max_retries` is reached or the retry budget is exhausted. The last
+    response is returned as-is.
+    """
+    attempt = 0
+    while True:
+        limiter.acquire()
+        response = send()
+        if response.status_code not in RETRY_STATUS_CODES or attempt >= max_retries:
+            return response
+
+        delay, from_server = get_retry_delay(response, attempt)
+        if not budget.consume(delay):
+            return response
+        if from_server:
+            # the server asked every client to slow down, not only this request
+            limiter.pause(delay)
+        else:
+            time.sleep(delay)
+        attempt += 1
@@ -1,29 +1,145 @@
-import json
+import logging
+import os
+import threading
+from collections import ChainMap, OrderedDict
+from ipaddress import IPv4Address, IPv6Address
 
 from crowdsec_utils import (
+    get_mmdb_backend,
     load_mmdb,
 )
 from crowdsec_constants import (
     DUMP_TYPE_CROWDSEC,
     DUMP_TYPE_GEOIP_ASN,
+    MMDB_BACKEND_AUTO,
+    MMDB_BACKEND_NATIVE,
 )
+from crowdsec_index import (
+    IntervalIndex,
+    MergedIndex,
+    compile_merged_index,
+    get_index_path,
+)
+from crowdsec_ip import parse_ip
+
+logger = logging.getLogger("crowdsec_readers")
 
 ALLOWED_DUMP_TYPES = {DUMP_TYPE_CROWDSEC, DUMP_TYPE_GEOIP_ASN}
 
+# Number of matched networks cached per search, shared between the network
+# caches of cssmoke and of each of its readers (see NetworkCache)
+NETWORK_CACHE_SIZE = 150000
+# Number of decoded MMDB records (and shared values) cached per database
+RECORD_CACHE_SIZE = 20000
+
+_MISSING = object()
+
+# Opened merged indexes: {path: (identity, MergedIndex)}
+_OPENED_MERGED = {}
+
+# Opened MMDB readers and their interval index, kept for the lifetime of the
+# process: {(path, backend): (identity, maxminddb reader, IntervalIndex or None)}
+_OPENED_MMDB = {}
+_OPENED_MMDB_LOCK = threading.Lock()
+
+
+def _file_identity(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def load_mmdb_index(path, reader):
+    """
+    Opens the interval index compiled for `path`. Returns None when there is no
+    index or when it was compiled from another version of the database.
+    """
+    index_path = get_index_path(path)
+    if not os.path.exists(index_path):
+        return None
+    try:
+        index = IntervalIndex(index_path)
+    except (OSError, ValueError) as exc:
+        logger.warning("Ignoring MMDB index %s: %s", index_path, exc)
+        return None
+    if not index.matches(reader, path):
+        logger.info("Ignoring outdated MMDB index %s", index_path)
+        index.close()
+        return None
+    return index
+
+
+def get_mmdb_reader(path, backend=MMDB_BACKEND_AUTO):
+    """
+    Returns an opened maxminddb reader for `path` and its interval index (or
+    None), reusing the ones opened by a previous call unless the files have
+    been replaced since (e.g. by download_mmdb.py).
+
+    The interval index is only used with the pure Python reader: the C
+    extension reader walks the search tree faster than the index is searched.
+    """
+    identity = (_file_identity(path), _file_identity(get_index_path(path)))
+    if identity[0] is None:
+        raise FileNotFoundError(path)
+    with _OPENED_MMDB_LOCK:
+        opened = _OPENED_MMDB.get((path, backend))
+        if opened is not None and opened[0] == identity:
+            return opened[1], opened[2]
+        if opened is not None and opened[0][0] == identity[0]:
+            # only the index changed
+            reader = opened[1]
+        else:
+            reader = load_mmdb(path, RECORD_CACHE_SIZE, backend)
+        # The previous reader and index are not closed: lookups in flight may
+        # still use them. Their memory maps stay valid after the files are
+        # replaced and are released once the last reference goes away.
+        index = None
+        if get_mmdb_backend(reader) != MMDB_BACKEND_NATIVE:
+            index = load_mmdb_index(path, reader)
+        _OPENED_MMDB[(path, backend)] = (identity, reader, index)
+        return reader, index
 
-def parse_crowdsec_mmdb_result(ip, mmdb_result):
-    data = json.loads(json.dumps(mmdb_result))
-    data["ip"] = ip
 
-    # we don't store proxy_or_vpn=false in the mmdb for now to save space
-    if "proxy_or_vpn" not in data:
-        data["proxy_or_vpn"] = False
+def get_merged_index(path):
+    """
+    Returns the merged index at `path` (or None if there is none), reusing the
+    one opened by a previous call unless the file has been replaced since.
+    """
+    identity = _file_identity(path)
+    if identity is None:
+        return None
+    with _OPENED_MMDB_LOCK:
+        opened = _OPENED_MERGED.get(path)
+        if opened is not None and opened[0] == identity:
+            return opened[1]
+        try:
+            index = MergedIndex(path)
+        except (OSError, ValueError) as exc:
+            logger.warning("Ignoring merged MMDB index %s: %s", path, exc)
+            index = None
+        _OPENED_MERGED[path] = (identity, index)
+        return index
 
-    return data
+
+# we don't store proxy_or_vpn=false in the mmdb for now to save space
+CROWDSEC_MMDB_DEFAULTS = {"proxy_or_vpn": False}
+
+
+def with_ip(result, ip):
+    """Returns a parsed result for another IP sharing the same record"""
+    return ChainMap({"ip": ip}, *result.maps[1:])
+
+
+def parse_crowdsec_mmdb_result(ip, mmdb_result):
+    # The record may be shared with the reader caches and other results: it
+    # is never modified, the added fields are layered over it instead.
+    return ChainMap({"ip": ip}, mmdb_result, CROWDSEC_MMDB_DEFAULTS)
 
 
 def parse_geoip_asn_mmdb_result(ip, mmdb_result):
-    data = {"ip": ip}
+    data = {}
     if "country" in mmdb_result:
         data["location"] = {}
 
@@ -35,7 +151,7 @@ def parse_geoip_asn_mmdb_result(ip, mmdb_result):
         if "AutonomousSystemOrganization" in mmdb_country:
             data["as_name"] = mmdb_country["AutonomousSystemOrganization"]
 
-    return data
+    return ChainMap({"ip": ip}, data)
 
 
 PARSE_MMDB_HANDLERS = {
@@ -44,8 +160,85 @@ PARSE_MMDB_HANDLERS = {
 }
 
 
+def compile_local_dump_index(dumps, index_path):
+    """
+    Merges the interval indexes of the local dumps into the index used by
+    MergedReader. `dumps` is a list of (mmdb path, dump type) in priority
+    order. The lower priority dumps are only kept for the networks where the
+    higher priority ones have no location, as in cssmoke.get_data_from_readers.
+    Returns (index path, IPv4 networks count, IPv6 networks count).
+    """
+    sources = []
+    for mmdb_path, dump_type in dumps:
+        parser = PARSE_MMDB_HANDLERS[dump_type]
+        sources.append(
+            (mmdb_path, lambda record, parser=parser: "location" in parser("", record))
+        )
+    return compile_merged_index(sources, index_path)
+
+
+class NetworkCache:
+    """
+    LRU cache of values per matched network, keyed by (ip version, prefix
+    length, network bits). Networks of a MMDB search tree never overlap, so an
+    IP matches at most one cached network.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._networks = OrderedDict()
+        self._prefix_lens = {4: set(), 6: set()}
+
+    def __len__(self):
+        return len(self._networks)
+
+    def get(self, version, ip_int, prefix_len=None):
+        """
+        Returns (value, prefix length) of the cached network of an IP, or
+        None. With `prefix_len`, only the network of that length is looked up.
+        """
+        bits = 32 if version == 4 else 128
+        networks = self._networks
+        prefix_lens = self._prefix_lens[version]
+        if prefix_len is not None:
+            prefix_lens = (prefix_len,)
+        for prefix_len in prefix_lens:
+            network = (version, prefix_len, ip_int >> (bits - prefix_len))
+            value = networks.get(network, _MISSING)
+            if value is not _MISSING:
+                # least recently used networks are evicted first
+                networks.move_to_end(network)
+                return value, prefix_len
+        return None
+
+    def put(self, version, ip_int, prefix_len, value):
+        bits = 32 if version == 4 else 128
+        networks = self._networks
+        self._prefix_lens[version].add(prefix_len)
+        networks[(version, prefix_len, ip_int >> (bits - prefix_len))] = value
+        if len(networks) > self.max_size:
+            networks.popitem(last=False)
+
+
 class Reader:
-    def __init__(self, name, output_filename, output_path, dump_type, priority):
+    def __init__(
+        self,
+        name,
+        output_filename,
+        output_path,
+        dump_type,
+        priority,
+        lazy=False,
+        backend=MMDB_BACKEND_AUTO,
+        network_cache_size=NETWORK_CACHE_SIZE,
+    ):
+        """
+        With `lazy`, the values of the records are only decoded when they are
+        read, which is cheaper when only a few fields of the records are used
+        (pure Python reader only). `backend` selects the MMDB reader, see
+        crowdsec_utils.load_mmdb. `network_cache_size` bounds the number of
+        matched networks whose raw records are cached.
+        """
         if dump_type not in ALLOWED_DUMP_TYPES:
             raise ValueError(f"Invalid dump type: {dump_type}")
 
@@ -54,13 +247,226 @@ class Reader:
         self.output_path = output_path
         self.dump_type = dump_type
         self.priority = priority
-        self.reader = load_mmdb(self.output_path)
+        self.lazy = lazy
+        self.reader, self.index = get_mmdb_reader(self.output_path, backend)
+        self.backend = get_mmdb_backend(self.reader)
+        self.native = self.backend == MMDB_BACKEND_NATIVE
+        self.parser = PARSE_MMDB_HANDLERS.get(self.dump_type)
+        if not self.parser:
+            raise ValueError(f"No parser found for dump type: {self.dump_type}")
+
+        # raw records of the networks matched so far
+        self._networks = NetworkCache(network_cache_size)
 
     def get(self, ip):
-        result = self.reader.get(ip)
+        return self.get_with_prefix_len(ip)[0]
+
+    def cache_info(self):
+        """Returns the record cache counters of the underlying MMDB reader"""
+        cache_info = getattr(self.reader, "cache_info", None)
+        return cache_info() if cache_info else None
+
+    def get_with_prefix_len(self, ip):
+        """Returns the parsed result and the prefix length of the matched network"""
+        key = parse_ip(ip)
+        if key is None:
+            raise ValueError(f"{ip!r} does not appear to be an IPv4 or IPv6 address")
+
+        result, prefix_len = self._get_raw(*key)
         if not result:
+            return None, prefix_len
+        return self.parser(ip, result), prefix_len
+
+    def get_many(self, ips):
+        """
+        Looks up a batch of IPs, see get_many_with_prefix_len.
+        Returns a dict {ip: parsed result or None}.
+        """
+        return {
+            ip: result for ip, (result, _) in self.get_many_with_prefix_len(ips).items()
+        }
+
+    def get_many_with_prefix_len(self, ips):
+        """
+        Looks up a batch of IPs. Returns a dict {ip: (parsed result or None,
+        prefix length of the matched network)}; invalid IPs are left out.
+
+        The IPs are resolved together and each matched record is decoded and
+        parsed once: the results of IPs sharing a record only differ by their
+        "ip" layer and share everything else, which must not be modified.
+        """
+        keys = {}
+        for ip in ips:
+            if ip in keys:
+                continue
+            key = parse_ip(ip)
+            if key is not None:
+                keys[ip] = key
+        return self.get_parsed_many_with_prefix_len(keys)
+
+    def get_parsed_many_with_prefix_len(self, keys):
+        """
+        Same as get_many_with_prefix_len for IPs already parsed with parse_ip:
+        `keys` is a dict {ip: (ip version, ip int)}.
+        """
+        found = self._get_raw_many(set(keys.values()))
+        parsed = {}
+        results = {}
+        for ip, key in keys.items():
+            if key not in found:
+                continue
+            record, prefix_len = found[key]
+            if not record:
+                results[ip] = (None, prefix_len)
+                continue
+            base = parsed.get(id(record))
+            if base is None:
+                base = parsed[id(record)] = self.parser(ip, record)
+            results[ip] = (with_ip(base, ip), prefix_len)
+        return results
+
+    def _get_raw(self, version, ip_int):
+        cached = self._networks.get(version, ip_int)
+        if cached is not None:
+            return cached
+
+        if self.index is not None:
+            pointer, prefix_len = self.index.lookup(version, ip_int)
+            result = (
+                self.reader._resolve_data_pointer(pointer, self.lazy)
+                if pointer
+                else None
+            )
+        elif self.native:
+            address = IPv4Address(ip_int) if version == 4 else IPv6Address(ip_int)
+            result, prefix_len = self.reader.get_with_prefix_len(address)
+        else:
+            result, prefix_len = self.reader.get_int_with_prefix_len(
+                ip_int, version, self.lazy
+            )
+        self._networks.put(version, ip_int, prefix_len, result)
+        return result, prefix_len
+
+    def _get_raw_many(self, keys):
+        """
+        Returns {(ip version, ip int): (raw record, prefix length)} for a set
+        of IPs. IPv6 addresses are left out of the result of an IPv4-only database.
+        """
+        found = {}
+        if self.index is None:
+            for version, ip_int in keys:
+                try:
+                    found[(version, ip_int)] = self._get_raw(version, ip_int)
+                except ValueError:
+                    continue
+            return found
+
+        # A sorted batch is resolved with one pass over the index, which is
+        # cheaper than probing the network cache for every prefix length.
+        # Each distinct record is decoded once per batch.
+        by_version = {4: [], 6: []}
+        for version, ip_int in keys:
+            by_version[version].append(ip_int)
+        records = {}
+        for version, ip_ints in by_version.items():
+            if not ip_ints:
+                continue
+            ip_ints.sort()
+            try:
+                matches = self.index.lookup_many(version, ip_ints)
+            except ValueError:
+                continue
+            for ip_int, (pointer, prefix_len) in zip(ip_ints, matches):
+                record = records.get(pointer, _MISSING)
+                if record is _MISSING:
+                    record = None
+                    if pointer:
+                        record = self.reader._resolve_data_pointer(pointer, self.lazy)
+                    records[pointer] = record
+                found[(version, ip_int)] = (record, prefix_len)
+        return found
+
+
+class MergedReader:
+    """
+    Looks up the local dumps through their merged index (see
+    compile_local_dump_index): each IP costs a single index search, and only
+    the records of the dumps that need to be consulted are decoded.
+    """
+
+    def __init__(self, readers, index):
+        self.readers = readers
+        self.index = index
+
+    @classmethod
+    def open(cls, readers, index_path):
+        """
+        Returns a MergedReader for `readers` (in priority order), or None when
+        the merged index is missing or outdated, or when a reader does not use
+        the pure Python backend.
+        """
+        if not readers or any(reader.native for reader in readers):
             return None
-        parser = PARSE_MMDB_HANDLERS.get(self.dump_type)
-        if not parser:
-            raise ValueError(f"No parser found for dump type: {self.dump_type}")
-        return parser(ip, result)
+        index = get_merged_index(index_path)
+        if index is None:
+            return None
+        if not index.matches(
+            [(reader.reader, reader.output_path) for reader in readers]
+        ):
+            logger.info("Ignoring outdated merged MMDB index %s", index_path)
+            return None
+        return cls(readers, index)
+
+    def get_parsed_many_with_prefix_len(self, keys):
+        """
+        Same as cssmoke.get_data_from_readers_many for IPs already parsed with
+        parse_ip: returns {ip: (merged result or None, prefix length)} for a dict
+        {ip: (ip version, ip int)}. Invalid IPs are left out.
+        """
+        by_version = {4: [], 6: []}
+        for key in set(keys.values()):
+            by_version[key[0]].append(key[1])
+
+        found = {}
+        for version, ip_ints in by_version.items():
+            if not ip_ints:
+                continue
+            ip_ints.sort()
+            try:
+                matches = self.index.lookup_many(version, ip_ints)
+            except ValueError:
+                continue
+            for ip_int, match in zip(ip_ints, matches):
+                found[(version, ip_int)] = match
+
+        # IPs matching the same pointers share the merged layers of their records
+        merged = {}
+        results = {}
+        for ip, key in keys.items():
+            match = found.get(key)
+            if match is None:
+                continue
+            pointers, prefix_len = match
+            maps = merged.get(pointers, _MISSING)
+            if maps is _MISSING:
+                maps = merged[pointers] = self._merge(ip, pointers)
+            result = ChainMap({"ip": ip}, *maps) if maps else None
+            results[ip] = (result, prefix_len)
+        return results
+
+    def _merge(self, ip, pointers):
+        """
+        Returns the layers of the merged result for the records at `pointers`,
+        or None when the merged result has no location, like
+        cssmoke.get_data_from_readers.
+        """
+        maps = []
+        for reader, pointer in zip(self.readers, pointers):
+            if not pointer:
+                continue
+            record = reader.reader._resolve_data_pointer(pointer, reader.lazy)
+            # the results of lower priority readers override the others
+            maps[:0] = reader.parser(ip, record).maps[1:]
+        if not any("location" in layer for layer in maps):
+            return None
+        return maps
@@ -0,0 +1,163 @@
+import configparser
+import json
+import logging
+import os
+import threading
+import time
+
+from splunklib.binding import HTTPError
+from splunklib.client import PATH_CONF
+
+from crowdsec_constants import APP_NAME, MMDB_BACKEND_AUTO, MMDB_BACKEND_PYTHON
+from crowdsec_cache import DEFAULT_CACHE_TTL, DEFAULT_CACHE_MAX_ENTRIES
+from crowdsec_ratelimit import (
+    DEFAULT_RATE_LIMIT,
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_RETRY_BUDGET,
+)
+
+logger = logging.getLogger("crowdsec_settings")
+
+SETTINGS_CONF = "crowdsec_settings"
+SETTINGS_STANZA = "settings"
+# Number of seconds the settings are reused by a process before being fetched again
+SETTINGS_TTL = 30
+
+DEFAULT_BATCH_SIZE = 10
+ALLOWED_BATCH_SIZES = {10, 20, 50, 100}
+DEFAULT_CONCURRENCY = 1
+MAX_CONCURRENCY = 8
+
+TRUE_VALUES = {"1", "true", "yes", "on"}
+
+_settings = {}
+_settings_lock = threading.Lock()
+
+
+def _flag(content, key, default):
+    value = content.get(key)
+    if value is None:
+        return default
+    return str(value).strip().lower() in TRUE_VALUES
+
+
+def _number(content, key, parse, default):
+    value = content.get(key)
+    if value is None:
+        return default
+    try:
+        return parse(value)
+    except (TypeError, ValueError):
+        logger.debug("Invalid %s '%s' in %s, using default", key, value, SETTINGS_CONF)
+        return default
+
+
+class CrowdsecSettings:
+    """
+    Typed values of the crowdsec_settings stanza. Missing or invalid values
+    are replaced by their defaults.
+    """
+
+    def __init__(self, content=None):
+        content = content or {}
+
+        self.local_dump = _flag(content, "local_dump", False)
+        self.distributed = _flag(content, "distributed", False)
+
+        self.batching = _flag(content, "batching", False)
+        self.batch_size = _number(content, "batch_size", int, DEFAULT_BATCH_SIZE)
+        if self.batch_size not in ALLOWED_BATCH_SIZES:
+            self.batch_size = DEFAULT_BATCH_SIZE
+        concurrency = _number(content, "concurrency", int, DEFAULT_CONCURRENCY)
+        self.concurrency = min(max(concurrency, 1), MAX_CONCURRENCY)
+
+        self.cache = _flag(content, "cache", True)
+        self.cache_ttl = _number(content, "cache_ttl", int, DEFAULT_CACHE_TTL)
+        self.cache_max_entries = _number(
+            content, "cache_max_entries", int, DEFAULT_CACHE_MAX_ENTRIES
+        )
+        if self.cache_ttl <= 0 or self.cache_max_entries <= 0:
+            self.cache = False
+
+        self.rate_limit = _number(content, "rate_limit", float, DEFAULT_RATE_LIMIT)
+        self.max_retries = max(
+            _number(content, "max_retries", int, DEFAULT_MAX_RETRIES), 0
+        )
+        self.retry_budget = max(
+            _number(content, "retry_budget", float, DEFAULT_RETRY_BUDGET), 0
+        )
+
+        backend = str(content.get("mmdb_backend") or MMDB_BACKEND_AUTO).lower()
+        self.mmdb_backend = (
+            MMDB_BACKEND_PYTHON if backend == MMDB_BACKEND_PYTHON else MMDB_BACKEND_AUTO
+        )
+
+        providers = str(content.get("vpn_providers") or "")
+        self.vpn_providers = [p.strip() for p in providers.split(",") if p.strip()]
+
+
+def fetch_settings_content(service):
+    """
+    Returns the keys of the crowdsec_settings stanza, fetched by name with a
+    single REST request, or {} when the app has not been configured yet.
+    """
+    try:
+        response = service.get(
+            PATH_CONF % SETTINGS_CONF + SETTINGS_STANZA,
+            owner="nobody",
+            app=APP_NAME,
+            output_mode="json",
+        )
+    except HTTPError as exc:
+        if exc.status == 404:
+            return {}
+        raise
+    entries = json.loads(response.body.read()).get("entry")
+    if not entries:
+        return {}
+    return entries[0].get("content") or {}
+
+
+def load_settings(service, ttl=SETTINGS_TTL):
+    """
+    Returns the CrowdsecSettings of the Splunk instance of `service`. They are
+    fetched at most once every `ttl` seconds per process.
+    """
+    if not service:
+        raise RuntimeError("Service not initialized; run as a Splunk search command")
+    key = service.authority
+    now = time.monotonic()
+    with _settings_lock:
+        cached = _settings.get(key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+    settings = CrowdsecSettings(fetch_settings_content(service))
+    with _settings_lock:
+        _settings[key] = (settings, now + ttl)
+    return settings
+
+
+def load_bundle_settings():
+    """
+    Returns the CrowdsecSettings of the search head, read from the
+    crowdsec_settings.conf files of the knowledge bundle. Search peers have no
+    REST access to the settings of the search head, but the app .conf files
+    are replicated with the bundle.
+    """
+    # relative to this script, which lives in the replicated bundle on search peers
+    app_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = configparser.ConfigParser(interpolation=None, strict=False)
+    parser.optionxform = str
+    try:
+        parser.read(
+            [
+                os.path.join(app_path, layer, SETTINGS_CONF + ".conf")
+                for layer in ("default", "local")
+            ]
+        )
+    except configparser.Error as exc:
+        logger.warning("Unable to read %s from the bundle: %s", SETTINGS_CONF, exc)
+        return CrowdsecSettings()
+    if not parser.has_section(SETTINGS_STANZA):
+        return CrowdsecSettings()
+    return CrowdsecSettings(dict(parser.items(SETTINGS_STANZA)))
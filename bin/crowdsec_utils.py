@@ -1,5 +1,26 @@
+import json
+import os
+import re
+import threading
+
 import maxminddb
-from crowdsec_constants import VERSION
+from maxminddb.const import MODE_AUTO, MODE_MMAP_EXT
+from splunklib.binding import HTTPError, UrlEncoded
+from crowdsec_constants import (
+    VERSION,
+    APP_NAME,
+    MMDB_BACKEND_AUTO,
+    MMDB_BACKEND_NATIVE,
+    MMDB_BACKEND_PYTHON,
+)
+
+
+API_KEY_NAME = "crowdsec-splunk-app_realm:api_key:"
+# CTI API responses meaning that the API key is invalid or has been revoked
+API_KEY_REJECTED_STATUS_CODES = {401, 403}
+
+_api_keys = {}
+_api_keys_lock = threading.Lock()
 
 
 def get_headers(api_key):
@@ -12,56 +33,185 @@ def get_headers(api_key):
     return headers
 
 
+def _fetch_api_key(service):
+    try:
+        response = service.get(
+            "storage/passwords/" + UrlEncoded(API_KEY_NAME, encode_slash=True),
+            owner="nobody",
+            app=APP_NAME,
+            output_mode="json",
+        )
+    except HTTPError as exc:
+        if exc.status == 404:
+            return None
+        raise
+    entries = json.loads(response.body.read()).get("entry")
+    if not entries:
+        return None
+    return (entries[0].get("content") or {}).get("clear_password")
+
+
 def load_api_key(service):
-    """Load API key from storage passwords"""
-    api_key = None
+    """
+    Load API key from storage passwords. The secret is fetched by name and
+    cached per process until it is rejected by the CTI API (see
+    reload_api_key).
+    """
     if not service:
         raise RuntimeError("Service not initialized; run as a Splunk search command")
-    for passw in service.storage_passwords.list():
-        if passw.name == "crowdsec-splunk-app_realm:api_key:":
-            api_key = passw.clear_password
-            break
+    key = service.authority
+    with _api_keys_lock:
+        api_key = _api_keys.get(key)
+    if api_key:
+        return api_key
+    api_key = _fetch_api_key(service)
+    if api_key:
+        with _api_keys_lock:
+            _api_keys[key] = api_key
     return api_key
 
 
-def load_mmdb(mmdb_path):
-    return maxminddb.open_database(mmdb_path)
+def reload_api_key(service, rejected_api_key):
+    """
+    Drops `rejected_api_key` from the cache after the CTI API answered with
+    one of API_KEY_REJECTED_STATUS_CODES, and loads the API key again.
+    Returns the new API key, or None when the stored one did not change.
+    """
+    with _api_keys_lock:
+        if _api_keys.get(service.authority) == rejected_api_key:
+            del _api_keys[service.authority]
+    api_key = load_api_key(service)
+    if api_key == rejected_api_key:
+        return None
+    return api_key
+
 
+def get_native_mmdb_extension():
+    """
+    Returns the maxminddb C extension compiled into bin/maxminddb, or None
+    when it is not available for this Python runtime. Extensions of other
+    maxminddb installs are not used: they are built for another version of
+    the package.
+    """
+    extension = getattr(maxminddb, "_extension", None)
+    if extension is not None and hasattr(extension, "Reader"):
+        return extension
+    return None
 
-def load_local_dump_settings(service):
-    local_dump_enabled = False
-    for conf in service.confs.list():
-        if conf.name == "crowdsec_settings":
-            stanza = conf.list()[0]
-            if stanza:
-                local_dump_enabled = (
-                    stanza.content.get("local_dump", "0").lower() == "1"
-                )
-    return local_dump_enabled
+
+def load_mmdb(mmdb_path, cache_size=0, backend=MMDB_BACKEND_AUTO):
+    """
+    Opens a MMDB with the C extension reader when available (unless
+    `backend` is MMDB_BACKEND_PYTHON), else with the pure Python reader.
+    `cache_size` only applies to the pure Python reader.
+    """
+    if backend != MMDB_BACKEND_PYTHON:
+        extension = get_native_mmdb_extension()
+        if extension is not None:
+            return extension.Reader(mmdb_path, MODE_MMAP_EXT)
+    return maxminddb.Reader(mmdb_path, MODE_AUTO, cache_size)
+
+
+def get_mmdb_backend(reader):
+    """Returns the backend of a reader opened by load_mmdb"""
+    if isinstance(reader, maxminddb.Reader):
+        return MMDB_BACKEND_PYTHON
+    return MMDB_BACKEND_NATIVE
+
+
+def is_search_peer():
+    """True when running from a knowledge bundle replicated to a search peer"""
+    return f"{os.sep}searchpeers{os.sep}" in os.path.abspath(__file__)
 
 
 VPN_PROVIDER = ["m247", "Datacamp", "PacketHub", "Proton AG", "Clouvider limited"]
 
+VPN_CLASSIFICATION = {
+    "description": "IP exposes a VPN service or is being flagged as one.",
+    "label": "VPN",
+    "name": "proxy:vpn",
+}
+
+# Number of distinct (as_name, as_num) pairs whose match is memoised
+VPN_MATCHES_MAX_SIZE = 10000
 
-def set_vpn(entry):
-    as_name = entry.get("as_name")
-    if not as_name:
-        return entry
-
-    for provider in VPN_PROVIDER:
-        if provider.lower() in as_name.lower():
-            entry["proxy_or_vpn"] = True
-            if "classifications" not in entry:
-                entry["classifications"] = dict()
-            if "classifications" not in entry["classifications"]:
-                entry["classifications"]["classifications"] = list()
-            entry["classifications"]["classifications"].append(
-                {
-                    "description": "IP exposes a VPN service or is being flagged as one.",
-                    "label": "VPN",
-                    "name": "proxy:vpn",
-                },
-            )
-            return entry
 
+class VpnProviderMatcher:
+    """
+    Matches the AS of a CTI record against a list of VPN providers.
+
+    A provider is either a case-insensitive substring of the AS name or an
+    AS number written "AS<number>". The names are compiled into a single
+    regex alternation and the result is memoised per (as_name, as_num), so
+    the cost of a lookup does not grow with the number of providers.
+    """
+
+    def __init__(self, providers):
+        self.providers = tuple(providers)
+        names = set()
+        as_nums = set()
+        for provider in self.providers:
+            if provider[:2].upper() == "AS" and provider[2:].isdigit():
+                as_nums.add(str(int(provider[2:])))
+            elif provider:
+                names.add(provider.lower())
+        self._search = None
+        if names:
+            self._search = re.compile("|".join(map(re.escape, sorted(names)))).search
+        self._as_nums = frozenset(as_nums)
+        self._matches = {}
+
+    def match(self, as_name, as_num=None):
+        """True when the AS name or number belongs to a VPN provider"""
+        key = (as_name, as_num)
+        try:
+            return self._matches[key]
+        except KeyError:
+            pass
+        except TypeError:
+            return self._match(as_name, as_num)
+        matched = self._match(as_name, as_num)
+        if len(self._matches) >= VPN_MATCHES_MAX_SIZE:
+            self._matches.clear()
+        self._matches[key] = matched
+        return matched
+
+    def _match(self, as_name, as_num):
+        if as_name and self._search is not None:
+            if self._search(str(as_name).lower()):
+                return True
+        return bool(as_num) and str(as_num) in self._as_nums
+
+
+_vpn_matcher = VpnProviderMatcher(VPN_PROVIDER)
+
+
+def set_vpn_providers(extra_providers=()):
+    """Matches VPN_PROVIDER and `extra_providers` in get_vpn_overlay and set_vpn"""
+    global _vpn_matcher
+    providers = tuple(VPN_PROVIDER) + tuple(extra_providers)
+    if providers != _vpn_matcher.providers:
+        _vpn_matcher = VpnProviderMatcher(providers)
+
+
+def get_vpn_overlay(entry):
+    """
+    Returns the fields to set over `entry` when its AS is a known VPN
+    provider, or None. `entry` and its nested values are not modified.
+    """
+    if not _vpn_matcher.match(entry.get("as_name"), entry.get("as_num")):
+        return None
+
+    classifications = dict(entry.get("classifications") or {})
+    classifications["classifications"] = [
+        *(classifications.get("classifications") or ()),
+        VPN_CLASSIFICATION,
+    ]
+    return {"proxy_or_vpn": True, "classifications": classifications}
+
+
+def set_vpn(entry):
+    overlay = get_vpn_overlay(entry)
+    if overlay:
+        entry.update(overlay)
     return entry
@@ -4,6 +4,8 @@ import sys
 import os
 import requests as req
 import time
+from collections import ChainMap, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from splunklib.searchcommands import (
     dispatch,
@@ -13,93 +15,119 @@ from splunklib.searchcommands import (
     validators,
 )
 
-from download_mmdb import get_mmdb_local_path
-from crowdsec_utils import get_headers, load_local_dump_settings, load_api_key, set_vpn
+from download_mmdb import get_mmdb_local_path, get_bundle_mmdb_path
+from crowdsec_utils import (
+    get_headers,
+    is_search_peer,
+    load_api_key,
+    reload_api_key,
+    API_KEY_REJECTED_STATUS_CODES,
+    get_vpn_overlay,
+    set_vpn,
+    set_vpn_providers,
+)
 from crowdsec_constants import (
+    MMDB_BACKEND_AUTO,
     LOCAL_DUMP_FILES,
+    LOCAL_DUMP_MERGED_INDEX,
     CROWDSEC_PROFILES,
     CROWDSEC_API_BASE_URL,
 )
-from crowdsec_readers import Reader
-
-DEFAULT_BATCH_SIZE = 10
-ALLOWED_BATCH_SIZES = {10, 20, 50, 100}
+from crowdsec_ip import parse_ip
+from crowdsec_settings import load_bundle_settings, load_settings
+from crowdsec_readers import (
+    NETWORK_CACHE_SIZE,
+    MergedReader,
+    NetworkCache,
+    Reader,
+)
+from crowdsec_cache import VerdictCache, get_cache_local_path
+from crowdsec_ratelimit import TokenBucket, RetryBudget, send_with_retry
+
+
+# Number of distinct IP results kept in memory for the whole search
+DEDUP_MAX_IPS = 100000
+# Number of distinct IPs looked up together in the local dumps
+LOCAL_DUMP_BATCH_SIZE = 1000
+# Maximum number of records held back while waiting for a batch to fill up
+MAX_PENDING_RECORDS = 10000
+
+
+# Fields that depend on the looked up IP or on the query rather than on the
+# CTI record: they are set on each record instead of being projected.
+OVERLAY_KEYS = ("ip", "query_time", "query_mode")
+
+# Output fields, in column order: (short name, key in the CTI response, sub-key)
+CROWDSEC_FIELDS = (
+    ("reputation", "reputation", None),
+    ("confidence", "confidence", None),
+    ("ip_range_score", "ip_range_score", None),
+    ("ip", "ip", None),
+    ("ip_range", "ip_range", None),
+    ("ip_range_24", "ip_range_24", None),
+    ("ip_range_24_reputation", "ip_range_24_reputation", None),
+    ("ip_range_24_score", "ip_range_24_score", None),
+    ("proxy_or_vpn", "proxy_or_vpn", None),
+    ("as_name", "as_name", None),
+    ("as_num", "as_num", None),
+    ("country", "location", "country"),
+    ("city", "location", "city"),
+    ("latitude", "location", "latitude"),
+    ("longitude", "location", "longitude"),
+    ("reverse_dns", "reverse_dns", None),
+    ("behaviors", "behaviors", None),
+    ("mitre_techniques", "mitre_techniques", None),
+    ("cves", "cves", None),
+    ("first_seen", "history", "first_seen"),
+    ("last_seen", "history", "last_seen"),
+    ("full_age", "history", "full_age"),
+    ("days_age", "history", "days_age"),
+    ("false_positives", "classifications", "false_positives"),
+    ("classifications", "classifications", "classifications"),
+    ("attack_details", "attack_details", None),
+    ("target_countries", "target_countries", None),
+    ("background_noise", "background_noise", None),
+    ("background_noise_score", "background_noise_score", None),
+    *(
+        (f"{period}_{score}", "scores", (period, score))
+        for period in ("overall", "last_day", "last_week", "last_month")
+        for score in ("aggressiveness", "threat", "trust", "anomaly", "total")
+    ),
+    ("references", "references", None),
+    ("query_time", "query_time", None),
+    ("query_mode", "query_mode", None),
+)
 
 
-def attach_resp_to_record(record, data, ipfield, allowed_fields=None):
+def build_projection(ipfield, allowed_fields=None):
+    """
+    Precompiles the output fields of a search into a tuple of
+    (output field name, key, sub-key) accessors, where sub-key is None, a key
+    or a tuple of keys.
+    """
     allowed = set(allowed_fields) if allowed_fields else None
     prefix = f"crowdsec_{ipfield}_"
+    return tuple(
+        (prefix + name, key, subkey)
+        for name, key, subkey in CROWDSEC_FIELDS
+        if allowed is None or name in allowed
+    )
+
 
-    location = data.get("location") or {}
-    history = data.get("history") or {}
-    classifications = data.get("classifications") or {}
-    scores = data.get("scores") or {}
-    overall = scores.get("overall") or {}
-    last_day = scores.get("last_day") or {}
-    last_week = scores.get("last_week") or {}
-    last_month = scores.get("last_month") or {}
-
-    mapped_fields = {
-        f"{prefix}reputation": data.get("reputation"),
-        f"{prefix}confidence": data.get("confidence"),
-        f"{prefix}ip_range_score": data.get("ip_range_score"),
-        f"{prefix}ip": data.get("ip"),
-        f"{prefix}ip_range": data.get("ip_range"),
-        f"{prefix}ip_range_24": data.get("ip_range_24"),
-        f"{prefix}ip_range_24_reputation": data.get("ip_range_24_reputation"),
-        f"{prefix}ip_range_24_score": data.get("ip_range_24_score"),
-        f"{prefix}proxy_or_vpn": data.get("proxy_or_vpn"),
-        f"{prefix}as_name": data.get("as_name"),
-        f"{prefix}as_num": data.get("as_num"),
-        f"{prefix}country": location.get("country"),
-        f"{prefix}city": location.get("city"),
-        f"{prefix}latitude": location.get("latitude"),
-        f"{prefix}longitude": location.get("longitude"),
-        f"{prefix}reverse_dns": data.get("reverse_dns"),
-        f"{prefix}behaviors": data.get("behaviors"),
-        f"{prefix}mitre_techniques": data.get("mitre_techniques"),
-        f"{prefix}cves": data.get("cves"),
-        f"{prefix}first_seen": history.get("first_seen"),
-        f"{prefix}last_seen": history.get("last_seen"),
-        f"{prefix}full_age": history.get("full_age"),
-        f"{prefix}days_age": history.get("days_age"),
-        f"{prefix}false_positives": classifications.get("false_positives"),
-        f"{prefix}classifications": classifications.get("classifications"),
-        f"{prefix}attack_details": data.get("attack_details"),
-        f"{prefix}target_countries": data.get("target_countries"),
-        f"{prefix}background_noise": data.get("background_noise"),
-        f"{prefix}background_noise_score": data.get("background_noise_score"),
-        f"{prefix}overall_aggressiveness": overall.get("aggressiveness"),
-        f"{prefix}overall_threat": overall.get("threat"),
-        f"{prefix}overall_trust": overall.get("trust"),
-        f"{prefix}overall_anomaly": overall.get("anomaly"),
-        f"{prefix}overall_total": overall.get("total"),
-        f"{prefix}last_day_aggressiveness": last_day.get("aggressiveness"),
-        f"{prefix}last_day_threat": last_day.get("threat"),
-        f"{prefix}last_day_trust": last_day.get("trust"),
-        f"{prefix}last_day_anomaly": last_day.get("anomaly"),
-        f"{prefix}last_day_total": last_day.get("total"),
-        f"{prefix}last_week_aggressiveness": last_week.get("aggressiveness"),
-        f"{prefix}last_week_threat": last_week.get("threat"),
-        f"{prefix}last_week_trust": last_week.get("trust"),
-        f"{prefix}last_week_anomaly": last_week.get("anomaly"),
-        f"{prefix}last_week_total": last_week.get("total"),
-        f"{prefix}last_month_aggressiveness": last_month.get("aggressiveness"),
-        f"{prefix}last_month_threat": last_month.get("threat"),
-        f"{prefix}last_month_trust": last_month.get("trust"),
-        f"{prefix}last_month_anomaly": last_month.get("anomaly"),
-        f"{prefix}last_month_total": last_month.get("total"),
-        f"{prefix}references": data.get("references"),
-        f"{prefix}query_time": data.get("query_time"),
-        f"{prefix}query_mode": data.get("query_mode"),
-    }
-
-    for field, value in mapped_fields.items():
-        short_field = field[len(prefix) :]
-        if allowed is None or short_field in allowed:
-            record[field] = value
-
-    return record
+def project_resp(data, projection):
+    """Returns the values of the projected fields of a CTI response, in order"""
+    values = []
+    for _, key, subkey in projection:
+        value = data.get(key)
+        if subkey is not None:
+            if not value:
+                value = None
+            elif type(subkey) is tuple:
+                value = (value.get(subkey[0]) or {}).get(subkey[1])
+            else:
+                value = value.get(subkey)
+        values.append(value)
+    return tuple(values)
 
 
 @Configuration(distributed=False)
@@ -126,14 +154,21 @@ class CsSmokeCommand(StreamingCommand):
         require=False,
     )
 
-    def stream(self, records):
+    def prepare(self):
+        # Under the chunked protocol, prepare() runs once per search while
+        # stream() runs once per chunk: everything that can be reused across
+        # chunks (settings, session, readers, caches) is initialised here.
         self._session = None
+        self._cache = None
+        self._executor = None
+        self._concurrency = 1
+        self._resolved = OrderedDict()
+        self._networks = None
         self.readers = []
-        self.api_key = load_api_key(self.service)
-        if not self.api_key:
-            raise Exception(
-                "No API Key found, please configure the app with CrowdSec CTI API Key"
-            )
+        self.merged_reader = None
+        self.api_key = None
+        self._mmdb_backend = MMDB_BACKEND_AUTO
+        self._readers_error = None
 
         allowed_fields = None
         if self.fields:
@@ -160,126 +195,143 @@ class CsSmokeCommand(StreamingCommand):
             if not allowed_fields:
                 allowed_fields = []
             allowed_fields.extend(merged_profile_fields)
-
-        batching_enabled, batch_size = self._load_batching_settings()
-        local_dump_enabled = load_local_dump_settings(self.service)
-        max_batch_size = batch_size if batching_enabled else 1
-
-        if local_dump_enabled:
+        self.projection = build_projection(self.ipfield, allowed_fields)
+        # narrow projections only read a few fields of the MMDB records
+        self._lazy_records = allowed_fields is not None
+        # overlay fields are set per record, everything else is pre-flattened
+        # once per IP into a tuple of values aligned with _data_fields
+        self._data_projection = tuple(
+            p for p in self.projection if p[1] not in OVERLAY_KEYS
+        )
+        self._data_fields = tuple(field for field, _, _ in self._data_projection)
+        overlay = {key: field for field, key, _ in self.projection}
+        self._ip_output = overlay.get("ip")
+        self._query_time_output = overlay.get("query_time")
+        self._query_mode_output = overlay.get("query_mode")
+
+        if is_search_peer():
+            # cssmoke is only distributed to search peers in local dump mode,
+            # where the API key is not needed. The settings of the search head
+            # come with the knowledge bundle.
+            settings = load_bundle_settings()
+            set_vpn_providers(settings.vpn_providers)
+            self.local_dump_enabled = True
+            self.max_batch_size = LOCAL_DUMP_BATCH_SIZE
+            self.configuration.distributed = True
+            self._mmdb_backend = settings.mmdb_backend
+            try:
+                self.load_readers()
+            except Exception as exc:
+                # fail the records of this peer rather than the whole search
+                self.logger.error("Unable to load the MMDB readers: %s", exc)
+                self.readers = []
+                self.merged_reader = None
+                self._readers_error = str(exc)
+            return
+
+        settings = load_settings(self.service)
+        self.local_dump_enabled = settings.local_dump
+        self.max_batch_size = settings.batch_size if settings.batching else 1
+        set_vpn_providers(settings.vpn_providers)
+
+        if self.local_dump_enabled:
+            # local lookups are resolved together by the readers, whatever
+            # the batching settings of the live CTI API
+            self.max_batch_size = LOCAL_DUMP_BATCH_SIZE
+            self._mmdb_backend = settings.mmdb_backend
             self.load_readers()
             if not self.readers:
                 self.logger.error(
                     "No MMDB readers loaded; local lookup is not possible. Run '| cssmokedownload' to download the databases."
                 )
-                return
+            elif settings.distributed:
+                # let the indexers run the lookups against the replicated MMDBs
+                self.configuration.distributed = True
         else:
+            self.api_key = load_api_key(self.service)
+            if not self.api_key:
+                raise Exception(
+                    "No API Key found, please configure the app with CrowdSec CTI API Key"
+                )
             self._session = req.Session()
+            self._cache = self._open_cache(settings)
+            self._init_rate_limiter(settings)
+            if settings.concurrency > 1:
+                self._concurrency = settings.concurrency
+                self._executor = ThreadPoolExecutor(max_workers=settings.concurrency)
+
+    def stream(self, records):
+        if self.local_dump_enabled and not self.readers:
+            if self._readers_error is not None:
+                for record in records:
+                    record[f"crowdsec_{self.ipfield}_error"] = self._readers_error
+                    yield record
+            return
 
         try:
             yield from self._process_records(
-                records, allowed_fields, max_batch_size, local_dump_enabled
+                records,
+                self.projection,
+                self.max_batch_size,
+                self.local_dump_enabled,
             )
         finally:
-            if self._session is not None:
-                try:
-                    self._session.close()
-                except Exception:
-                    pass
-
-    def _load_batching_settings(self):
-        batching = False
-        batch_size = DEFAULT_BATCH_SIZE
+            metadata = self.metadata
+            if metadata is None or getattr(metadata, "finished", False):
+                self._release_resources()
+
+    def _release_resources(self):
+        for reader in self.readers:
+            self.logger.debug(
+                "MMDB %s record cache: %s", reader.name, reader.cache_info()
+            )
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+        if self._session is not None:
+            try:
+                self._session.close()
+            except Exception:
+                pass
+            self._session = None
+
+    def _init_rate_limiter(self, settings):
+        self._limiter = TokenBucket(settings.rate_limit)
+        self._retry_budget = RetryBudget(settings.retry_budget)
+        self._max_retries = settings.max_retries
+
+    def _open_cache(self, settings):
+        if not settings.cache:
+            return None
         try:
-            for conf in self.service.confs.list():
-                if conf.name == "crowdsec_settings":
-                    stanza = conf.list()[0]  # TODO: make stanza selection explicit
-                    if stanza:
-                        batching = stanza.content.get("batching", "0").lower() == "1"
-                        raw_size = stanza.content.get("batch_size", DEFAULT_BATCH_SIZE)
-                        try:
-                            parsed_size = int(raw_size)
-                            if parsed_size in ALLOWED_BATCH_SIZES:
-                                batch_size = parsed_size
-                        except (TypeError, ValueError):
-                            self.logger.debug(
-                                "Invalid batch_size '%s' in config, using default",
-                                raw_size,
-                            )
+            return VerdictCache(
+                get_cache_local_path(), settings.cache_ttl, settings.cache_max_entries
+            )
         except Exception as exc:
-            self.logger.debug("Unable to load batching settings: %s", exc)
-        return batching, batch_size
-
-    def _add_default_fields_to_record(self, record, allowed_fields):
-        allowed = set(allowed_fields) if allowed_fields else None
-        prefix = f"crowdsec_{self.ipfield}_"
-
-        default_fields = {
-            f"{prefix}reputation": "",
-            f"{prefix}confidence": "",
-            f"{prefix}ip_range_score": "",
-            f"{prefix}ip": "",
-            f"{prefix}ip_range": "",
-            f"{prefix}ip_range_24": "",
-            f"{prefix}ip_range_24_reputation": "",
-            f"{prefix}ip_range_24_score": "",
-            f"{prefix}proxy_or_vpn": "",
-            f"{prefix}as_name": "",
-            f"{prefix}as_num": "",
-            f"{prefix}country": "",
-            f"{prefix}city": "",
-            f"{prefix}latitude": "",
-            f"{prefix}longitude": "",
-            f"{prefix}reverse_dns": "",
-            f"{prefix}behaviors": "",
-            f"{prefix}mitre_techniques": "",
-            f"{prefix}cves": "",
-            f"{prefix}first_seen": "",
-            f"{prefix}last_seen": "",
-            f"{prefix}full_age": "",
-            f"{prefix}days_age": "",
-            f"{prefix}false_positives": "",
-            f"{prefix}classifications": "",
-            f"{prefix}attack_details": "",
-            f"{prefix}target_countries": "",
-            f"{prefix}background_noise": "",
-            f"{prefix}background_noise_score": "",
-            f"{prefix}overall_aggressiveness": "",
-            f"{prefix}overall_threat": "",
-            f"{prefix}overall_trust": "",
-            f"{prefix}overall_anomaly": "",
-            f"{prefix}overall_total": "",
-            f"{prefix}last_day_aggressiveness": "",
-            f"{prefix}last_day_threat": "",
-            f"{prefix}last_day_trust": "",
-            f"{prefix}last_day_anomaly": "",
-            f"{prefix}last_day_total": "",
-            f"{prefix}last_week_aggressiveness": "",
-            f"{prefix}last_week_threat": "",
-            f"{prefix}last_week_trust": "",
-            f"{prefix}last_week_anomaly": "",
-            f"{prefix}last_week_total": "",
-            f"{prefix}last_month_aggressiveness": "",
-            f"{prefix}last_month_threat": "",
-            f"{prefix}last_month_trust": "",
-            f"{prefix}last_month_anomaly": "",
-            f"{prefix}last_month_total": "",
-            f"{prefix}references": "",
-            f"{prefix}query_time": "",
-            f"{prefix}query_mode": "",
-        }
-
-        for field, value in default_fields.items():
-            short_field = field[len(prefix) :]
-            if allowed is None or short_field in allowed:
-                record[field] = value
-
-    def _process_records(self, records, allowed_fields, batch_size, local_dump_enabled):
-        buffer = []
+            self.logger.debug("Unable to open verdict cache: %s", exc)
+            return None
+
+    def _add_default_fields_to_record(self, record, projection):
+        for field, _, _ in projection:
+            record[field] = ""
+
+    def _process_records(self, records, projection, batch_size, local_dump_enabled):
+        # Records are held back (in order) until enough distinct unresolved IPs
+        # are collected to fill a batch. Each distinct IP is looked up once and
+        # its result is fanned out to every record carrying it.
+        pending = []
+        unresolved = {}
         first_record = True
 
+        # keep every worker busy: collect one batch per worker before flushing
+        flush_size = batch_size * self._concurrency
+
         for record in records:
             if first_record:
-                self._add_default_fields_to_record(record, allowed_fields)
+                self._add_default_fields_to_record(record, projection)
                 first_record = False
 
             record_dest_ip = record.get(self.ipfield)
@@ -287,30 +339,120 @@ class CsSmokeCommand(StreamingCommand):
                 record[f"crowdsec_{self.ipfield}_error"] = (
                     f"Field {self.ipfield} not found in record"
                 )
-                yield record
+            elif not isinstance(record_dest_ip, str):
+                # multivalue fields can't be used as a deduplication key
+                record[f"crowdsec_{self.ipfield}_error"] = (
+                    f"Field {self.ipfield} must contain a single IP"
+                )
+            if not isinstance(record_dest_ip, str) or not record_dest_ip:
+                if pending:
+                    pending.append((record, None))
+                else:
+                    yield record
+                continue
+
+            if not pending and record_dest_ip in self._resolved:
+                self._resolved.move_to_end(record_dest_ip)
+                yield self._apply_resolution(
+                    record, record_dest_ip, self._resolved[record_dest_ip]
+                )
                 continue
 
-            buffer.append((record, record_dest_ip))
+            pending.append((record, record_dest_ip))
+            if record_dest_ip not in self._resolved:
+                unresolved[record_dest_ip] = None
 
-            if len(buffer) >= batch_size:
-                yield from self._execute_batch(
-                    buffer, allowed_fields, local_dump_enabled
+            if len(unresolved) >= flush_size or len(pending) >= MAX_PENDING_RECORDS:
+                yield from self._flush(
+                    pending, batch_size, projection, local_dump_enabled
                 )
-                buffer = []
+                pending = []
+                unresolved = {}
 
-        if buffer:
-            yield from self._execute_batch(buffer, allowed_fields, local_dump_enabled)
+        if pending:
+            yield from self._flush(pending, batch_size, projection, local_dump_enabled)
+
+    def _flush(self, pending, batch_size, projection, local_dump_enabled):
+        resolutions = {}
+        to_resolve = []
+        for _, ip in pending:
+            if ip is None or ip in resolutions:
+                continue
+            resolution = self._resolved.get(ip)
+            if resolution is not None:
+                resolutions[ip] = resolution
+            else:
+                resolutions[ip] = None
+                to_resolve.append(ip)
+
+        batches = [
+            to_resolve[i : i + batch_size]
+            for i in range(0, len(to_resolve), batch_size)
+        ]
+        if self._executor is not None and len(batches) > 1:
+            all_results = self._executor.map(
+                lambda batch: self._execute_batch(batch, local_dump_enabled), batches
+            )
+        else:
+            all_results = (
+                self._execute_batch(batch, local_dump_enabled) for batch in batches
+            )
+
+        for results in all_results:
+            resolutions.update(results)
+            for ip, resolution in results.items():
+                # errors are not remembered so that later batches retry them
+                if resolution[1] is None:
+                    self._remember(ip, resolution)
+
+        for record, ip in pending:
+            if ip is None:
+                yield record
+            else:
+                yield self._apply_resolution(record, ip, resolutions[ip])
+
+    def _remember(self, ip, resolution):
+        self._resolved[ip] = resolution
+        if len(self._resolved) > DEDUP_MAX_IPS:
+            self._resolved.popitem(last=False)
+
+    def _apply_resolution(self, record, ip, resolution):
+        values, error, query_time, mode = resolution
+        if error is not None:
+            record[f"crowdsec_{self.ipfield}_error"] = error
+        elif values is not None:
+            record.update(zip(self._data_fields, values))
+            if self._ip_output:
+                record[self._ip_output] = ip
+            if self._query_time_output:
+                record[self._query_time_output] = query_time
+            if self._query_mode_output:
+                record[self._query_mode_output] = mode
+        else:
+            record[f"crowdsec_{self.ipfield}_reputation"] = "unknown"
+            record[f"crowdsec_{self.ipfield}_confidence"] = "none"
+            record[f"crowdsec_{self.ipfield}_query_time"] = query_time
+            record[f"crowdsec_{self.ipfield}_query_mode"] = mode
+        return record
 
     def load_readers(self):
         self.readers = []
+        self.merged_reader = None
 
         entries = sorted(
             LOCAL_DUMP_FILES.items(),
             key=lambda kv: int(kv[1].get("priority", 999999)),
         )
 
+        # on search peers, the MMDBs come with the replicated knowledge bundle
+        get_path = get_bundle_mmdb_path if is_search_peer() else get_mmdb_local_path
+
+        # the network caches of the command and of its readers share a bound
+        network_cache_size = NETWORK_CACHE_SIZE // (len(entries) + 1)
+        self._networks = NetworkCache(network_cache_size)
+
         for entry, info in entries:
-            mmdb_path = get_mmdb_local_path(info["output_filename"])
+            mmdb_path = get_path(info["output_filename"])
             if not os.path.isfile(mmdb_path):
                 raise Exception(
                     f"MMDB file '{info['crowdsec_dump_name']}' not found, run 'cssmokedownload' command to download the CrowdSec lookup database."
@@ -323,117 +465,218 @@ class CsSmokeCommand(StreamingCommand):
                     output_path=mmdb_path,
                     dump_type=info["dump_type"],
                     priority=info["priority"],
+                    lazy=self._lazy_records,
+                    backend=self._mmdb_backend,
+                    network_cache_size=network_cache_size,
                 )
             )
 
+        if self.readers:
+            self.logger.info(
+                "MMDB reader backend: %s",
+                ", ".join(sorted({reader.backend for reader in self.readers})),
+            )
+            self.merged_reader = MergedReader.open(
+                self.readers, get_path(LOCAL_DUMP_MERGED_INDEX)
+            )
+
     def get_data_from_readers(self, ip):
-        result = {}
+        """
+        Returns (result, prefix_len): the merged reader results and the
+        prefix length of the network they apply to, i.e. the most specific
+        network matched by the readers that were consulted.
+        """
+        return self.get_data_from_readers_many([ip]).get(ip, (None, 0))
+
+    def get_data_from_readers_many(self, ips, keys=None):
+        """
+        Same as get_data_from_readers for a batch of IPs: {ip: (result, prefix_len)}
+        `keys` optionally gives the IPs already parsed, {ip: parse_ip(ip)}.
+
+        The results of the readers are not copied: each result is a read-only
+        ChainMap of the reader results, the higher priority ones last.
+        """
+        prefix_lens = dict.fromkeys(ips, 0)
+        if keys is None:
+            keys = {ip: parse_ip(ip) for ip in prefix_lens}
+
+        if self.merged_reader is not None:
+            # a single search per IP in the index merging all the readers
+            results = self.merged_reader.get_parsed_many_with_prefix_len(
+                {ip: keys[ip] for ip in prefix_lens if keys.get(ip) is not None}
+            )
+            for ip in prefix_lens:
+                results.setdefault(ip, (None, 0))
+            return results
+
+        layers = {}
+        results = {}
+        remaining = list(prefix_lens)
         for reader in self.readers:
-            try:
-                data = reader.get(ip)
-            except ValueError:
-                # don't fail if it is not a valid IP address
-                continue
-            if not data:
-                continue
-            result.update(data)
+            if not remaining:
+                break
+            found = reader.get_parsed_many_with_prefix_len(
+                {ip: keys[ip] for ip in remaining if keys.get(ip) is not None}
+            )
+            next_remaining = []
+            for ip in remaining:
+                # invalid IP addresses are left out by the readers
+                if ip not in found:
+                    next_remaining.append(ip)
+                    continue
+                data, reader_prefix_len = found[ip]
+                prefix_len = max(prefix_lens[ip], reader_prefix_len)
+                prefix_lens[ip] = prefix_len
+                if not data:
+                    next_remaining.append(ip)
+                    continue
+                result = layers.get(ip)
+                result = layers[ip] = (
+                    data if result is None else ChainMap(data, result)
+                )
 
-            # if country is not found, continue to next reader
-            if "location" not in result:
+                # if country is not found, continue to next reader
+                if "location" not in result:
+                    next_remaining.append(ip)
+                    continue
+
+                results[ip] = (result, prefix_len)
+            remaining = next_remaining
+
+        for ip in remaining:
+            results[ip] = (None, prefix_lens[ip])
+        return results
+
+    def _lookup_local_many(self, ips):
+        """
+        Returns {ip: flattened values or None} for a batch of IPs from the local
+        dumps. Results are cached per matched network, so any IP of an already
+        seen network costs a few dict lookups; the others are resolved
+        together by the readers.
+        """
+        results = {}
+        to_resolve = {}
+        networks = self._networks
+        for ip in ips:
+            key = parse_ip(ip)
+            if key is None:
+                results[ip] = None
                 continue
 
-            if result:
-                return result
-        return None
+            cached = networks.get(*key)
+            if cached is not None:
+                results[ip] = cached[0]
+            else:
+                to_resolve[ip] = key
+
+        if not to_resolve:
+            return results
+
+        found = self.get_data_from_readers_many(list(to_resolve), to_resolve)
+        for ip, (version, ip_int) in to_resolve.items():
+            result, prefix_len = found[ip]
+            # another IP of the batch may have matched the same network
+            cached = networks.get(version, ip_int, prefix_len)
+            if cached is not None:
+                values = cached[0]
+            else:
+                values = None
+                if result:
+                    vpn = get_vpn_overlay(result)
+                    if vpn:
+                        result = ChainMap(vpn, result)
+                    values = project_resp(result, self._data_projection)
+                networks.put(version, ip_int, prefix_len, values)
+            results[ip] = values
+        return results
+
+    def _api_get(self, url, headers, params):
+        client = self._session if self._session is not None else req
+        return send_with_retry(
+            lambda: client.get(url, headers=headers, params=params),
+            self._limiter,
+            self._retry_budget,
+            self._max_retries,
+        )
 
     def get_data_from_api(self, ip, headers):
-        client = self._session if self._session is not None else req
         params = (("ipAddress", ip), ("verbose", ""))
-        return client.get(
-            f"{CROWDSEC_API_BASE_URL}/v2/smoke/{ip}",
-            headers=headers,
-            params=params,
-        )
+        return self._api_get(f"{CROWDSEC_API_BASE_URL}/v2/smoke/{ip}", headers, params)
 
     def get_data_from_api_batch(self, ips, headers):
-        client = self._session if self._session is not None else req
         params = {"ips": ",".join(ips)}
-        return client.get(
-            f"{CROWDSEC_API_BASE_URL}/v2/smoke",
-            headers=headers,
-            params=params,
-        )
+        return self._api_get(f"{CROWDSEC_API_BASE_URL}/v2/smoke", headers, params)
 
-    def _execute_batch(self, buffer, allowed_fields, local_dump_enabled):
+    def _execute_batch(self, ips, local_dump_enabled):
+        """
+        Looks up a batch of distinct IPs.
+
+        Returns a dict {ip: (values, error, query_time, query_mode)} where
+        values are the projected fields (None for IPs unknown to CrowdSec) and
+        error is set when the lookup failed.
+        """
         t_batch0 = time.perf_counter()
 
-        headers = get_headers(self.api_key)
         data = []
         mode = "local_dump" if local_dump_enabled else "api"
 
         if local_dump_enabled:
-            for _, ip in buffer:
-                ip_info = self.get_data_from_readers(ip)
-                if ip_info:
-                    data.append(ip_info)
-
-            batch_seconds = time.perf_counter() - t_batch0
-
-        else:
-            response = None
-            try:
-                if len(buffer) == 1:
-                    _, ip = buffer[0]
-                    response = self.get_data_from_api(ip, headers)
-                    batch_seconds = time.perf_counter() - t_batch0
-
-                    if response.status_code == 200:
-                        try:
-                            data.append(response.json())
-                        except Exception as exc:
-                            for record, _ in buffer:
-                                record[f"crowdsec_{self.ipfield}_error"] = (
-                                    f"Error parsing JSON response: {exc}"
-                                )
-                                yield record
-                            return
-                else:
-                    response = self.get_data_from_api_batch(
-                        [ip for _, ip in buffer], headers
-                    )
-                    batch_seconds = time.perf_counter() - t_batch0
-
-                    if response.status_code == 200:
-                        try:
-                            data = self._normalize_batch_response(response.json())
-                        except Exception as exc:
-                            for record, _ in buffer:
-                                record[f"crowdsec_{self.ipfield}_error"] = (
-                                    f"Error parsing JSON response: {exc}"
-                                )
-                                yield record
-                            return
+            found = self._lookup_local_many(ips)
+            query_time = f"{time.perf_counter() - t_batch0:.2f}s"
+            return {
+                ip: (values, None, query_time, mode) for ip, values in found.items()
+            }
+
+        api_key = self.api_key
+        headers = get_headers(api_key)
+        cached = {}
+        if self._cache is not None:
+            cached = self._cache.get_many(ips)
+        to_fetch = [ip for ip in ips if ip not in cached]
+
+        # errors only apply to the fetched IPs: cached verdicts are still returned
+        error_msg = None
+        response = None
+        try:
+            # the single IP endpoint is only used for batches of one IP, like
+            # without the cache
+            if len(ips) == 1 and to_fetch:
+                response = self.get_data_from_api(to_fetch[0], headers)
+
+                if response.status_code == 200:
+                    try:
+                        data.append(response.json())
+                    except Exception as exc:
+                        error_msg = f"Error parsing JSON response: {exc}"
+            elif to_fetch:
+                response = self.get_data_from_api_batch(to_fetch, headers)
+
+                if response.status_code == 200:
+                    try:
+                        data = self._normalize_batch_response(response.json())
+                    except Exception as exc:
+                        error_msg = f"Error parsing JSON response: {exc}"
 
-            except Exception as exc:
-                for record, _ in buffer:
-                    record[f"crowdsec_{self.ipfield}_error"] = f"Request failed: {exc}"
-                    yield record
-                return
-
-            if response is not None and response.status_code != 200:
-                if response.status_code == 429:
-                    error_msg = (
-                        '"Quota exceeded for CrowdSec CTI API. Please visit '
-                        "[https://www.crowdsec.net/pricing](https://www.crowdsec.net/pricing) "
-                        'to upgrade your plan."'
-                    )
-                else:
-                    error_msg = f"Error {response.status_code} : {response.text}"
+        except Exception as exc:
+            error_msg = f"Request failed: {exc}"
+        batch_seconds = time.perf_counter() - t_batch0
+
+        if error_msg is None and response is not None and response.status_code != 200:
+            if response.status_code in API_KEY_REJECTED_STATUS_CODES:
+                # the API key may have been replaced since it was loaded
+                self._reload_api_key(api_key)
+            if response.status_code == 429:
+                error_msg = (
+                    '"Quota exceeded for CrowdSec CTI API. Please visit '
+                    "[https://www.crowdsec.net/pricing](https://www.crowdsec.net/pricing) "
+                    'to upgrade your plan."'
+                )
+            else:
+                error_msg = f"Error {response.status_code} : {response.text}"
 
-                for record, _ in buffer:
-                    record[f"crowdsec_{self.ipfield}_error"] = error_msg
-                    yield record
-                return
+        if error_msg is None and self._cache is not None and to_fetch:
+            self._store_in_cache(to_fetch, data)
+        data.extend(entry for entry in cached.values() if entry)
 
         data_by_ip = {}
         for entry in data:
@@ -443,20 +686,39 @@ class CsSmokeCommand(StreamingCommand):
 
         query_time = f"{batch_seconds:.2f}s"
 
-        for record, ip in buffer:
+        results = {}
+        for ip in ips:
+            if error_msg is not None and ip not in cached:
+                results[ip] = (None, error_msg, "", mode)
+                continue
             entry = data_by_ip.get(ip)
+            values = None
             if entry:
-                entry = set_vpn(entry)
-                entry["query_time"] = query_time
-                entry["query_mode"] = mode
-                attach_resp_to_record(record, entry, self.ipfield, allowed_fields)
-                yield record
-            else:
-                record[f"crowdsec_{self.ipfield}_reputation"] = "unknown"
-                record[f"crowdsec_{self.ipfield}_confidence"] = "none"
-                record[f"crowdsec_{self.ipfield}_query_time"] = query_time
-                record[f"crowdsec_{self.ipfield}_query_mode"] = mode
-                yield record
+                values = project_resp(set_vpn(entry), self._data_projection)
+            results[ip] = (values, None, query_time, mode)
+        return results
+
+    def _reload_api_key(self, rejected_api_key):
+        try:
+            api_key = reload_api_key(self.service, rejected_api_key)
+        except Exception as exc:
+            self.logger.debug("Unable to reload API key: %s", exc)
+            return
+        if api_key:
+            self.logger.info("API key changed, using the new one for next requests")
+            self.api_key = api_key
+
+    def _store_in_cache(self, requested_ips, data):
+        entries = {}
+        for entry in data:
+            ip = entry.get("ip")
+            if ip:
+                entries[ip] = entry
+        # IPs missing from a batch response are unknown to the CTI
+        if len(requested_ips) > 1:
+            for ip in requested_ips:
+                entries.setdefault(ip, None)
+        self._cache.set_many(entries)
 
     def _normalize_batch_response(self, data):
         if isinstance(data, dict) and isinstance(data.get("items"), list):
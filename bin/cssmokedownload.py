@@ -14,12 +14,24 @@ from splunklib.searchcommands import (
     Option,
 )
 
-from crowdsec_utils import load_api_key, get_headers
-from crowdsec_constants import LOCAL_DUMP_FILES
+from crowdsec_utils import (
+    load_api_key,
+    reload_api_key,
+    get_headers,
+    API_KEY_REJECTED_STATUS_CODES,
+)
+from crowdsec_constants import LOCAL_DUMP_FILES, LOCAL_DUMP_MERGED_INDEX
+from crowdsec_index import get_index_path
 from download_mmdb import (
+    NOT_MODIFIED,
+    DOWNLOAD_PROGRESS,
     get_mmdb_local_path,
     fetch_mmdb_download_urls,
-    download_to_file,
+    download_files,
+    get_dump_checksum,
+    compile_mmdb_index,
+    compile_mmdb_merged_index,
+    load_dump_manifest,
 )
 
 logger = logging.getLogger("cssmokedownload")
@@ -72,6 +84,10 @@ class CsSmokeDownloadCommand(GeneratingCommand):
             "message": "",
             "file_size_mb": "",
             "download_time": "",
+            "etag": "",
+            "remote_last_modified": "",
+            "sha256": "",
+            "last_check": "",
         }
 
         def make_event(**kwargs):
@@ -79,10 +95,22 @@ class CsSmokeDownloadCommand(GeneratingCommand):
             ev.update(kwargs)
             return ev
 
+        def set_validators(ev, validators):
+            if validators:
+                ev["etag"] = validators.get("etag", "")
+                ev["remote_last_modified"] = validators.get("last_modified", "")
+                ev["sha256"] = validators.get("sha256", "")
+                checked_at = validators.get("checked_at")
+                if checked_at:
+                    ev["last_check"] = datetime.datetime.fromtimestamp(
+                        checked_at
+                    ).isoformat(timespec="seconds")
+
         mode = (self.mode or "download").strip().lower()
 
         # INFO MODE: no API calls, no downloads
         if mode == "info":
+            manifest = load_dump_manifest()
             for entry, info in LOCAL_DUMP_FILES.items():
                 dump_name = info.get("crowdsec_dump_name", entry)
                 filename = info.get("output_filename", "")
@@ -106,8 +134,22 @@ class CsSmokeDownloadCommand(GeneratingCommand):
                     ev["message"] = "File exists."
                     ev["last_update"] = last_update
                     ev["file_size_mb"] = size_mb
+                    set_validators(ev, manifest.get(mmdb_path))
 
                 yield ev
+
+            ev = make_event(name="merged_index", file=LOCAL_DUMP_MERGED_INDEX)
+            ev["path"] = get_mmdb_local_path(LOCAL_DUMP_MERGED_INDEX)
+            exists, last_update, size_mb = self._file_info(ev["path"])
+            if not exists:
+                ev["status"] = "missing"
+                ev["message"] = "File not found; lookups query each MMDB in turn."
+            else:
+                ev["status"] = "ok"
+                ev["message"] = "File exists."
+                ev["last_update"] = last_update
+                ev["file_size_mb"] = size_mb
+            yield ev
             return
 
         if mode not in ("download", ""):
@@ -128,6 +170,15 @@ class CsSmokeDownloadCommand(GeneratingCommand):
         try:
             try:
                 resp = fetch_mmdb_download_urls(session, api_key)
+                if (
+                    resp is not None
+                    and resp.status_code in API_KEY_REJECTED_STATUS_CODES
+                ):
+                    # retry once if the API key was replaced since it was loaded
+                    new_api_key = reload_api_key(self.service, api_key)
+                    if new_api_key:
+                        api_key = new_api_key
+                        resp = fetch_mmdb_download_urls(session, api_key)
             except Exception as exc:
                 yield make_event(
                     status="error", message=f"Failed to fetch MMDB download URLs: {exc}"
@@ -169,7 +220,12 @@ class CsSmokeDownloadCommand(GeneratingCommand):
                 return
 
             headers = get_headers(api_key)
+            manifest = load_dump_manifest()
+            any_downloaded = False
+            t0 = time.perf_counter()
 
+            downloads = []
+            events = {}
             for entry, info in LOCAL_DUMP_FILES.items():
                 dump_name = info.get("crowdsec_dump_name", entry)
                 filename = info.get("output_filename", "")
@@ -194,12 +250,43 @@ class CsSmokeDownloadCommand(GeneratingCommand):
                     yield ev
                     continue
 
-                try:
-                    t0 = time.perf_counter()
-                    ok, msg, size_bytes, seconds = download_to_file(
-                        session, mmdb_info["url"], mmdb_path, headers=headers
+                downloads.append(
+                    (
+                        dump_name,
+                        mmdb_info["url"],
+                        mmdb_path,
+                        get_dump_checksum(mmdb_info),
                     )
-                    _ = time.perf_counter() - t0
+                )
+                events[dump_name] = ev
+
+            # the MMDBs are downloaded concurrently: events are sent in the
+            # order the downloads complete
+            for event, dump_name, result in download_files(
+                session, downloads, headers, manifest
+            ):
+                ev = events[dump_name]
+                mmdb_path = ev["path"]
+
+                if event == DOWNLOAD_PROGRESS:
+                    # SCP v1 only returns the results once the command is over:
+                    # progress is logged rather than sent as result rows
+                    done, total = result
+                    done_mb = done / (1024.0 * 1024.0)
+                    if total:
+                        self.logger.info(
+                            "Downloading %s: %.0fMB of %.0fMB (%d%%)",
+                            dump_name,
+                            done_mb,
+                            total / (1024.0 * 1024.0),
+                            100 * done // total,
+                        )
+                    else:
+                        self.logger.info("Downloading %s: %.0fMB", dump_name, done_mb)
+                    continue
+
+                try:
+                    ok, msg, size_bytes, seconds = result
 
                     ev["download_time"] = f"{seconds:.2f}s"
                     ev["file_size_mb"] = f"{(size_bytes / (1024.0 * 1024.0)):.0f}MB"
@@ -210,9 +297,22 @@ class CsSmokeDownloadCommand(GeneratingCommand):
                         ev["last_update"] = last_update
                         ev["file_size_mb"] = size_mb
 
-                    if ok:
+                    set_validators(ev, manifest.get(mmdb_path))
+
+                    if ok and msg == NOT_MODIFIED:
+                        ev["status"] = "ok"
+                        ev["message"] = "Not modified since last download."
+                        if not os.path.isfile(get_index_path(mmdb_path)):
+                            indexed, msg, _, _ = compile_mmdb_index(mmdb_path)
+                            if not indexed:
+                                ev["message"] += f" {msg}"
+                    elif ok:
+                        any_downloaded = True
                         ev["status"] = "ok"
                         ev["message"] = "Downloaded successfully."
+                        indexed, msg, _, _ = compile_mmdb_index(mmdb_path)
+                        if not indexed:
+                            ev["message"] += f" {msg}"
                     else:
                         ev["status"] = "error"
                         ev["message"] = f"Download failed: {msg}"
@@ -223,6 +323,33 @@ class CsSmokeDownloadCommand(GeneratingCommand):
 
                 yield ev
 
+            try:
+                manifest.save()
+            except OSError as exc:
+                logger.warning("Manifest %s not updated: %s", manifest.path, exc)
+
+            ev = make_event(name="merged_index", file=LOCAL_DUMP_MERGED_INDEX)
+            ev["path"] = get_mmdb_local_path(LOCAL_DUMP_MERGED_INDEX)
+            if any_downloaded or not os.path.isfile(ev["path"]):
+                merged, msg, _, seconds = compile_mmdb_merged_index()
+                ev["download_time"] = f"{seconds:.2f}s"
+            else:
+                merged, msg = True, ""
+            exists, last_update, size_mb = self._file_info(ev["path"])
+            if exists:
+                ev["last_update"] = last_update
+                ev["file_size_mb"] = size_mb
+            if not merged:
+                ev["status"] = "error"
+                ev["message"] = msg
+            elif any_downloaded:
+                ev["status"] = "ok"
+                ev["message"] = "Built successfully."
+            else:
+                ev["status"] = "ok"
+                ev["message"] = "Up to date."
+            yield ev
+
         finally:
             try:
                 session.close()
@@ -6,19 +6,43 @@ Download CrowdSec MMDB files (daily via Splunk scripted input).
 import os
 import sys
 import time
+import json
+import queue
+import random
+import hashlib
 import logging
+import ipaddress
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import maxminddb
 import requests
 import splunklib.client as client
+from maxminddb.const import MODE_MMAP
 
 from crowdsec_constants import (
     LOCAL_DUMP_FILES,
+    LOCAL_DUMP_MERGED_INDEX,
+    LOCAL_DUMP_MANIFEST,
     CROWDSEC_API_BASE_URL,
     APP_NAME,
     DEFAULT_SPLUNK_HOME,
 )
-from crowdsec_utils import get_headers, load_api_key
+from crowdsec_utils import (
+    get_headers,
+    load_api_key,
+    reload_api_key,
+    API_KEY_REJECTED_STATUS_CODES,
+)
+from crowdsec_settings import load_settings
+from crowdsec_index import compile_index, get_index_path
+from crowdsec_readers import compile_local_dump_index
 
 
 logger = logging.getLogger("crowdsec_mmdb_downloader")
@@ -30,6 +54,27 @@ _handler.setFormatter(
 logger.handlers = [_handler]
 logger.propagate = False
 
+# download_to_file message when the remote dump matches the local file
+NOT_MODIFIED = "Not modified"
+# Suffix of the file a MMDB is downloaded to, kept to resume failed downloads
+PARTIAL_SUFFIX = ".part"
+# Number of times a dropped download is resumed with a Range request
+DOWNLOAD_MAX_RESUMES = 3
+# Number of seconds before resuming a dropped download, doubled on each retry
+DOWNLOAD_RESUME_DELAY = 1
+# Number of MMDBs downloaded at the same time
+DOWNLOAD_CONCURRENCY = 4
+# Minimum number of seconds between two progress reports of a download
+PROGRESS_INTERVAL = 5
+# Hash algorithms of the checksums accepted from the /v2/dump response
+CHECKSUM_ALGORITHMS = ("sha256", "sha512", "sha1", "md5")
+# Number of pseudo-random IPs looked up to validate a downloaded MMDB
+VALIDATION_SAMPLES = 256
+
+# download_files events
+DOWNLOAD_PROGRESS = "progress"
+DOWNLOAD_DONE = "done"
+
 
 def get_splunk_service():
     # Prefer passAuth token when requested.
@@ -75,19 +120,18 @@ def get_mmdb_local_path(mmdb_file):
     return path
 
 
+def get_bundle_mmdb_path(mmdb_file):
+    # relative to this script, which lives in the replicated bundle on search peers
+    app_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(app_path, "lookups/mmdb", mmdb_file)
+
+
 def load_local_dump_enabled(service):
-    local_dump_enabled = False
     try:
-        for conf in service.confs.list():
-            if conf.name == "crowdsec_settings":
-                stanza = conf.list()[0]  # TODO: select stanza explicitly if multiple
-                if stanza:
-                    local_dump_enabled = (
-                        stanza.content.get("local_dump", "0").lower() == "1"
-                    )
+        return load_settings(service).local_dump
     except Exception as exc:
         logger.error("Unable to load 'local_dump' setting: %s", exc)
-    return local_dump_enabled
+    return False
 
 
 def fetch_mmdb_download_urls(session, api_key):
@@ -96,45 +140,415 @@ def fetch_mmdb_download_urls(session, api_key):
     return session.get(url, headers=headers, timeout=30)
 
 
+def _get_validators(resp):
+    return {
+        "etag": resp.headers.get("ETag", ""),
+        "last_modified": resp.headers.get("Last-Modified", ""),
+    }
+
+
+class DumpManifest:
+    """
+    Validators of the downloaded MMDBs (ETag, Last-Modified, size and SHA-256),
+    stored in a JSON file next to them and keyed by MMDB file name.
+
+    They are only trusted while the local file still has the recorded size,
+    so that a file replaced or truncated by hand is downloaded again. The
+    validators of partial downloads are stored under their file name too, to
+    resume them with a Range request.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        # downloads update the manifest from several threads
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                self.entries = entries
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as exc:
+            logger.warning("Ignoring unreadable manifest %s: %s", path, exc)
+
+    def get(self, mmdb_path):
+        """Returns the validators of `mmdb_path`, or None if they are outdated"""
+        entry = self.entries.get(os.path.basename(mmdb_path))
+        if not isinstance(entry, dict):
+            return None
+        try:
+            if os.path.getsize(mmdb_path) != entry.get("size"):
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def conditional_headers(self, mmdb_path):
+        """HTTP headers asking to download `mmdb_path` only if it changed"""
+        entry = self.get(mmdb_path) or {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def is_unchanged(self, mmdb_path, resp):
+        """True when a response sent the validators of the local `mmdb_path`"""
+        entry = self.get(mmdb_path)
+        if entry is None:
+            return False
+        etag = resp.headers.get("ETag")
+        if etag:
+            return etag == entry.get("etag")
+        last_modified = resp.headers.get("Last-Modified")
+        return bool(last_modified) and last_modified == entry.get("last_modified")
+
+    def update(self, mmdb_path, validators, size, sha256):
+        now = int(time.time())
+        with self._lock:
+            self.entries[os.path.basename(mmdb_path)] = {
+                **validators,
+                "size": size,
+                "sha256": sha256,
+                "downloaded_at": now,
+                "checked_at": now,
+            }
+            self.entries.pop(os.path.basename(mmdb_path) + PARTIAL_SUFFIX, None)
+
+    def checked(self, mmdb_path):
+        entry = self.get(mmdb_path)
+        if entry is not None:
+            entry["checked_at"] = int(time.time())
+
+    def get_partial(self, mmdb_path):
+        """Returns the validators of the partial download of `mmdb_path`"""
+        entry = self.entries.get(os.path.basename(mmdb_path) + PARTIAL_SUFFIX)
+        if not isinstance(entry, dict):
+            return None
+        if not entry.get("etag") and not entry.get("last_modified"):
+            return None
+        return entry
+
+    def set_partial(self, mmdb_path, validators):
+        with self._lock:
+            key = os.path.basename(mmdb_path) + PARTIAL_SUFFIX
+            if validators:
+                self.entries[key] = dict(validators)
+            else:
+                self.entries.pop(key, None)
+
+    def save(self):
+        dst_dir = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(prefix=".manifest_tmp_", dir=dst_dir)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                with self._lock:
+                    json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def load_dump_manifest():
+    return DumpManifest(get_mmdb_local_path(LOCAL_DUMP_MANIFEST))
+
+
+def _get_range_start(resp):
+    # "Content-Range: bytes <start>-<end>/<total>"
+    try:
+        return int(resp.headers.get("Content-Range", "").split()[1].split("-")[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def _get_total_size(resp, offset):
+    total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+    if total.isdigit():
+        return int(total)
+    length = resp.headers.get("Content-Length", "")
+    if length.isdigit():
+        return offset + int(length)
+    return None
+
+
+def _new_hashes(algorithms):
+    return [hashlib.new(algorithm) for algorithm in algorithms]
+
+
+def _is_resumable(validators):
+    return bool(validators and (validators["etag"] or validators["last_modified"]))
+
+
+def _hash_file(path, chunk_size, algorithms):
+    hashes = _new_hashes(algorithms)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            for h in hashes:
+                h.update(chunk)
+    return hashes
+
+
+def get_dump_checksum(mmdb_info):
+    """
+    Returns the (algorithm, hex digest) announced for a dump in the /v2/dump
+    response, or None. Both {"sha256": "<hex>"} and
+    {"checksum": "sha256:<hex>"} forms are accepted.
+    """
+    for algorithm in CHECKSUM_ALGORITHMS:
+        value = mmdb_info.get(algorithm)
+        if isinstance(value, str) and value.strip():
+            return algorithm, value.strip().lower()
+    value = mmdb_info.get("checksum")
+    if isinstance(value, str) and ":" in value:
+        algorithm, _, digest = value.partition(":")
+        algorithm = algorithm.strip().lower().replace("-", "")
+        if algorithm in CHECKSUM_ALGORITHMS and digest.strip():
+            return algorithm, digest.strip().lower()
+    return None
+
+
+def validate_mmdb(mmdb_path, samples=VALIDATION_SAMPLES):
+    """
+    Checks that a downloaded MMDB is usable before it replaces the current
+    one: its metadata must parse and the lookups of a fixed sample of IPs
+    must walk the search tree and decode their records.
+    Returns (ok, message).
+    """
+    try:
+        reader = maxminddb.open_database(mmdb_path, MODE_MMAP)
+    except Exception as exc:
+        return False, f"Invalid MMDB metadata: {exc}"
+    try:
+        metadata = reader.metadata()
+        if metadata.ip_version not in (4, 6) or metadata.node_count <= 0:
+            return False, "Invalid MMDB metadata: empty search tree"
+        # the same IPs are checked on every download
+        rng = random.Random(0)
+        for i in range(samples):
+            if metadata.ip_version == 6 and i % 2:
+                # global unicast addresses, 2000::/3
+                ip = ipaddress.IPv6Address(1 << 125 | rng.getrandbits(125))
+            else:
+                ip = ipaddress.IPv4Address(rng.getrandbits(32))
+            reader.get(ip)
+    except Exception as exc:
+        return False, f"Invalid MMDB: {exc}"
+    finally:
+        reader.close()
+    return True, "OK"
+
+
 def download_to_file(
-    session, url, dst_path, headers, timeout=(10, 180), chunk_size=1024 * 256
+    session,
+    url,
+    dst_path,
+    headers,
+    timeout=(10, 180),
+    chunk_size=1024 * 256,
+    manifest=None,
+    progress=None,
+    max_resumes=DOWNLOAD_MAX_RESUMES,
+    checksum=None,
 ):
+    """
+    Downloads `url` to `dst_path`. Returns (ok, message, bytes_written, seconds).
+
+    The download goes to `dst_path` + PARTIAL_SUFFIX, which replaces
+    `dst_path` once complete. A dropped transfer is resumed up to
+    `max_resumes` times with a Range request, as long as the remote file did
+    not change (If-Range).
+
+    With a `manifest`, the download is conditional on the validators of the
+    local file and the message is NOT_MODIFIED when the remote dump is
+    unchanged. A failed download is then kept to be resumed by the next call.
+    The manifest is updated but not saved.
+
+    `progress(bytes_done, bytes_total)` is called every PROGRESS_INTERVAL
+    seconds, bytes_total being None when the size is not known.
+
+    The file is hashed while it is written. Before replacing `dst_path`, its
+    digest is compared with `checksum` ((algorithm, hex digest), if any) and
+    the file is checked with validate_mmdb.
+    """
     t0 = time.perf_counter()
     bytes_written = 0
 
     dst_dir = os.path.dirname(dst_path)
     os.makedirs(dst_dir, exist_ok=True)
 
-    fd, tmp_path = tempfile.mkstemp(prefix=".mmdb_tmp_", dir=dst_dir)
+    part_path = dst_path + PARTIAL_SUFFIX
+    part = open(part_path, "ab")
+    keep_part = False
+    offset = 0
+    validators = None
     try:
-        with os.fdopen(fd, "wb") as f:
-            resp = session.get(url, headers=headers, timeout=timeout, stream=True)
-            if resp.status_code != 200:
+        if fcntl is not None:
+            try:
+                fcntl.flock(part.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                part.close()
+                part = None
+                return False, "Download already in progress", 0, 0.0
+
+        # a partial download is only resumed if the validators of the remote
+        # file it comes from are known
+        validators = manifest.get_partial(dst_path) if manifest is not None else None
+        offset = part.tell() if validators else 0
+        # SHA-256 for the manifest, then the algorithm of `checksum` if different
+        algorithms = ["sha256"]
+        if checksum is not None and checksum[0] != "sha256":
+            algorithms.append(checksum[0])
+        if offset:
+            hashes = _hash_file(part_path, chunk_size, algorithms)
+        else:
+            hashes = _new_hashes(algorithms)
+        resumes = 0
+        last_report = time.monotonic()
+
+        def resume_or_fail(interrupted):
+            # returns the result of the download when it cannot be resumed
+            nonlocal resumes, keep_part
+            part.flush()
+            resumable = _is_resumable(validators)
+            if resumes >= max_resumes or not resumable:
+                keep_part = resumable
+                return (
+                    False,
+                    f"Download interrupted: {interrupted}",
+                    bytes_written,
+                    time.perf_counter() - t0,
+                )
+            logger.warning(
+                "Download of %s interrupted after %d bytes, resuming: %s",
+                os.path.basename(dst_path),
+                offset,
+                interrupted,
+            )
+            time.sleep(DOWNLOAD_RESUME_DELAY * 2**resumes)
+            resumes += 1
+            return None
+
+        while True:
+            req_headers = dict(headers)
+            if offset:
+                req_headers["Range"] = f"bytes={offset}-"
+                req_headers["If-Range"] = (
+                    validators["etag"] or validators["last_modified"]
+                )
+            elif manifest is not None:
+                req_headers.update(manifest.conditional_headers(dst_path))
+
+            try:
+                resp = session.get(
+                    url, headers=req_headers, timeout=timeout, stream=True
+                )
+            except requests.RequestException as exc:
+                if not offset:
+                    raise
+                # the connection is still down when resuming
+                failure = resume_or_fail(exc)
+                if failure is not None:
+                    return failure
+                continue
+
+            if resp.status_code == 304 and manifest is not None:
+                resp.close()
+                manifest.checked(dst_path)
+                return True, NOT_MODIFIED, 0, time.perf_counter() - t0
+
+            if resp.status_code == 206 and offset and _get_range_start(resp) == offset:
+                total = _get_total_size(resp, offset)
+            elif resp.status_code == 200:
+                if manifest is not None and manifest.is_unchanged(dst_path, resp):
+                    # the server ignored the conditional headers
+                    resp.close()
+                    manifest.checked(dst_path)
+                    return True, NOT_MODIFIED, 0, time.perf_counter() - t0
+                # the remote file changed since the partial download, or the
+                # server does not support ranges: start over
+                offset = 0
+                part.truncate(0)
+                hashes = _new_hashes(algorithms)
+                validators = _get_validators(resp)
+                if manifest is not None:
+                    manifest.set_partial(dst_path, validators)
+                total = _get_total_size(resp, 0)
+            elif resp.status_code in (206, 416) and offset:
+                # unexpected range, or the partial download is not a part of
+                # the remote file anymore: start over
+                resp.close()
+                offset = 0
+                part.truncate(0)
+                validators = None
+                continue
+            else:
                 text_snippet = ""
                 try:
                     text_snippet = (resp.text or "")[:200]
                 except Exception:
                     pass
+                keep_part = offset > 0
                 return (
                     False,
                     f"HTTP {resp.status_code} {text_snippet}".strip(),
-                    0,
+                    bytes_written,
                     time.perf_counter() - t0,
                 )
 
-            for chunk in resp.iter_content(chunk_size=chunk_size):
-                if not chunk:
-                    continue
-                f.write(chunk)
-                bytes_written += len(chunk)
-
-            f.flush()
-            os.fsync(f.fileno())
+            interrupted = None
+            try:
+                for chunk in resp.iter_content(chunk_size=chunk_size):
+                    if not chunk:
+                        continue
+                    part.write(chunk)
+                    for h in hashes:
+                        h.update(chunk)
+                    offset += len(chunk)
+                    bytes_written += len(chunk)
+                    if progress is not None:
+                        now = time.monotonic()
+                        if now - last_report >= PROGRESS_INTERVAL:
+                            last_report = now
+                            progress(offset, total)
+            except requests.RequestException as exc:
+                interrupted = exc
+            if interrupted is None and total is not None and offset < total:
+                interrupted = f"connection closed after {offset} of {total} bytes"
+            if interrupted is None:
+                break
+            failure = resume_or_fail(interrupted)
+            if failure is not None:
+                return failure
+
+        part.flush()
+        os.fsync(part.fileno())
+
+        if checksum is not None:
+            digest = hashes[algorithms.index(checksum[0])].hexdigest()
+            if digest != checksum[1]:
+                return (
+                    False,
+                    f"{checksum[0]} checksum mismatch: expected {checksum[1]}, "
+                    f"got {digest}",
+                    bytes_written,
+                    time.perf_counter() - t0,
+                )
+        valid, msg = validate_mmdb(part_path)
+        if not valid:
+            return False, msg, bytes_written, time.perf_counter() - t0
 
-        os.replace(tmp_path, dst_path)
+        os.replace(part_path, dst_path)
+        if manifest is not None:
+            manifest.update(dst_path, validators, offset, hashes[0].hexdigest())
         return True, "", bytes_written, time.perf_counter() - t0
 
     except Exception as exc:
+        # keep what was downloaded for the next call to resume it
+        keep_part = offset > 0 and _is_resumable(validators)
         return (
             False,
             f"Exception while downloading: {exc}",
@@ -143,11 +557,97 @@ def download_to_file(
         )
 
     finally:
+        if part is not None:
+            part.close()
+            try:
+                if not keep_part and os.path.exists(part_path):
+                    os.remove(part_path)
+                    if manifest is not None:
+                        manifest.set_partial(dst_path, None)
+            except Exception:
+                pass
+
+
+def download_files(session, downloads, headers, manifest=None):
+    """
+    Downloads [(name, url, dst_path, checksum)] with download_to_file,
+    DOWNLOAD_CONCURRENCY at a time.
+
+    Yields (DOWNLOAD_PROGRESS, name, (bytes_done, bytes_total)) while the
+    files are downloaded and (DOWNLOAD_DONE, name, download_to_file result)
+    as soon as each download is over.
+    """
+    if not downloads:
+        return
+    events = queue.Queue()
+
+    def download(name, url, dst_path, checksum):
+        def progress(done, total):
+            events.put((DOWNLOAD_PROGRESS, name, (done, total)))
+
         try:
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
-        except Exception:
-            pass
+            result = download_to_file(
+                session,
+                url,
+                dst_path,
+                headers,
+                manifest=manifest,
+                progress=progress,
+                checksum=checksum,
+            )
+        except Exception as exc:
+            result = (False, f"Exception while downloading: {exc}", 0, 0.0)
+        events.put((DOWNLOAD_DONE, name, result))
+
+    workers = min(DOWNLOAD_CONCURRENCY, len(downloads))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for download_args in downloads:
+            executor.submit(download, *download_args)
+        remaining = len(downloads)
+        while remaining:
+            event = events.get()
+            if event[0] == DOWNLOAD_DONE:
+                remaining -= 1
+            yield event
+
+
+def compile_mmdb_index(mmdb_path):
+    """
+    Compiles the interval index of a downloaded MMDB.
+    Returns (ok, message, networks_count, seconds).
+    Lookups fall back to the MMDB search tree when there is no usable index.
+    """
+    start = time.time()
+    try:
+        _, v4_count, v6_count = compile_index(mmdb_path)
+    except Exception as exc:
+        return False, f"Failed to compile index: {exc}", 0, time.time() - start
+    return True, "OK", v4_count + v6_count, time.time() - start
+
+
+def compile_mmdb_merged_index():
+    """
+    Merges the interval indexes of the downloaded MMDBs into the index used to
+    look up all of them with a single search.
+    Returns (ok, message, networks_count, seconds).
+    Lookups fall back to querying the MMDBs one after the other when there is
+    no usable merged index.
+    """
+    start = time.time()
+    entries = sorted(
+        LOCAL_DUMP_FILES.values(), key=lambda info: int(info.get("priority", 999999))
+    )
+    dumps = [
+        (get_mmdb_local_path(info["output_filename"]), info["dump_type"])
+        for info in entries
+    ]
+    try:
+        _, v4_count, v6_count = compile_local_dump_index(
+            dumps, get_mmdb_local_path(LOCAL_DUMP_MERGED_INDEX)
+        )
+    except Exception as exc:
+        return False, f"Failed to compile merged index: {exc}", 0, time.time() - start
+    return True, "OK", v4_count + v6_count, time.time() - start
 
 
 def main():
@@ -165,6 +665,12 @@ def main():
     session = requests.Session()
     try:
         resp = fetch_mmdb_download_urls(session, api_key)
+        if resp.status_code in API_KEY_REJECTED_STATUS_CODES:
+            # retry once if the API key was replaced since it was loaded
+            new_api_key = reload_api_key(service, api_key)
+            if new_api_key:
+                api_key = new_api_key
+                resp = fetch_mmdb_download_urls(session, api_key)
         if resp.status_code != 200:
             logger.error(
                 "Failed to fetch MMDB download URLs: HTTP %s: %s",
@@ -184,8 +690,12 @@ def main():
             return 1
 
         headers = get_headers(api_key)
+        manifest = load_dump_manifest()
         any_failed = False
+        any_downloaded = False
 
+        downloads = []
+        dst_paths = {}
         for entry, info in LOCAL_DUMP_FILES.items():
             mmdb_name = info["crowdsec_dump_name"]
             dst_path = get_mmdb_local_path(info["output_filename"])
@@ -199,17 +709,28 @@ def main():
                 any_failed = True
                 continue
 
-            url = mmdb_info["url"]
             logger.info("Downloading MMDB %s -> %s", mmdb_name, dst_path)
-
-            ok, msg, size_bytes, seconds = download_to_file(
-                session, url, dst_path, headers=headers
+            downloads.append(
+                (mmdb_name, mmdb_info["url"], dst_path, get_dump_checksum(mmdb_info))
             )
-            if ok:
+            dst_paths[mmdb_name] = dst_path
+
+        for event, mmdb_name, result in download_files(
+            session, downloads, headers, manifest
+        ):
+            if event == DOWNLOAD_PROGRESS:
+                done, total = result
                 logger.info(
-                    "Downloaded %s (%d bytes) in %.2fs", mmdb_name, size_bytes, seconds
+                    "Downloading %s: %d of %s bytes",
+                    mmdb_name,
+                    done,
+                    total if total is not None else "?",
                 )
-            else:
+                continue
+
+            dst_path = dst_paths[mmdb_name]
+            ok, msg, size_bytes, seconds = result
+            if not ok:
                 logger.error(
                     "Failed to download %s: %s (after %.2fs, wrote %d bytes)",
                     mmdb_name,
@@ -218,6 +739,43 @@ def main():
                     size_bytes,
                 )
                 any_failed = True
+                continue
+
+            if msg == NOT_MODIFIED:
+                logger.info("MMDB %s not modified since last download", mmdb_name)
+                if os.path.isfile(get_index_path(dst_path)):
+                    continue
+            else:
+                any_downloaded = True
+                logger.info(
+                    "Downloaded %s (%d bytes) in %.2fs", mmdb_name, size_bytes, seconds
+                )
+
+            indexed, msg, networks, seconds = compile_mmdb_index(dst_path)
+            if indexed:
+                logger.info(
+                    "Indexed %s (%d networks) in %.2fs",
+                    mmdb_name,
+                    networks,
+                    seconds,
+                )
+            else:
+                logger.warning("Index of %s not updated: %s", mmdb_name, msg)
+
+        try:
+            manifest.save()
+        except OSError as exc:
+            logger.warning("Manifest %s not updated: %s", manifest.path, exc)
+
+        merged_index_path = get_mmdb_local_path(LOCAL_DUMP_MERGED_INDEX)
+        if any_downloaded or not os.path.isfile(merged_index_path):
+            merged, msg, networks, seconds = compile_mmdb_merged_index()
+            if merged:
+                logger.info(
+                    "Built merged index (%d networks) in %.2fs", networks, seconds
+                )
+            else:
+                logger.warning("Merged index not updated: %s", msg)
 
         return 1 if any_failed else 0
 
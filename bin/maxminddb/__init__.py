@@ -40,6 +40,7 @@ __all__ = [
 def open_database(
     database: AnyStr | int | os.PathLike | IO,
     mode: int = MODE_AUTO,
+    cache_size: int = 0,
 ) -> Reader:
     """Open a MaxMind DB database.
 
@@ -55,6 +56,9 @@ def open_database(
                           a path. This mode implies MODE_MEMORY.
               * MODE_AUTO - tries MODE_MMAP_EXT, MODE_MMAP, MODE_FILE in that
                           order. Default mode.
+        cache_size: number of decoded records kept in memory by the pure
+                    Python reader, 0 (default) disables the record cache.
+                    The C extension ignores it.
 
     """
     if mode not in (
@@ -72,7 +76,7 @@ def open_database(
     use_extension = has_extension if mode == MODE_AUTO else mode == MODE_MMAP_EXT
 
     if not use_extension:
-        return Reader(database, mode)
+        return Reader(database, mode, cache_size)
 
     if not has_extension:
         msg = "MODE_MMAP_EXT requires the maxminddb.extension module to be available"
@@ -1,7 +1,8 @@
 """Decoder for the MaxMind DB data section."""
 
 import struct
-from typing import ClassVar, Union, cast
+from collections import OrderedDict
+from typing import Callable, ClassVar, Union, cast
 
 try:
     import mmap
@@ -11,7 +12,7 @@ except ImportError:
 
 from maxminddb.errors import InvalidDatabaseError
 from maxminddb.file import FileBuffer
-from maxminddb.types import Record
+from maxminddb.types import LazyRecordDict, Record, freeze
 
 
 class Decoder:
@@ -22,6 +23,7 @@ class Decoder:
         database_buffer: Union[FileBuffer, "mmap.mmap", bytes],
         pointer_base: int = 0,
         pointer_test: bool = False,  # noqa: FBT001, FBT002
+        cache_size: int = 0,
     ) -> None:
         """Create a Decoder for a MaxMind DB.
 
@@ -29,11 +31,18 @@ class Decoder:
             database_buffer: an mmap'd MaxMind DB file.
             pointer_base: the base number to use when decoding a pointer
             pointer_test: used for internal unit testing of pointer code
+            cache_size: maximum number of values kept in the record cache,
+                        0 disables the cache. See decode_cached.
 
         """
         self._pointer_test = pointer_test
         self._buffer = database_buffer
         self._pointer_base = pointer_base
+        self._cache_size = cache_size
+        self._cache: OrderedDict[int, tuple[Record, int]] = OrderedDict()
+        self._lazy_cache: OrderedDict[int, tuple[Record, int]] = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def _decode_array(self, size: int, offset: int) -> tuple[list[Record], int]:
         array = []
@@ -83,6 +92,13 @@ class Decoder:
         return container, offset
 
     def _decode_pointer(self, size: int, offset: int) -> tuple[Record, int]:
+        (pointer, new_offset) = self._read_pointer(size, offset)
+        if self._pointer_test:
+            return pointer, new_offset
+        (value, _) = self.decode_cached(pointer)
+        return value, new_offset
+
+    def _read_pointer(self, size: int, offset: int) -> tuple[int, int]:
         pointer_size = (size >> 3) + 1
 
         buf = self._buffer[offset : offset + pointer_size]
@@ -99,11 +115,7 @@ class Decoder:
             pointer = struct.unpack(b"!I", buf)[0] + 526336 + self._pointer_base
         else:
             pointer = struct.unpack(b"!I", buf)[0] + self._pointer_base
-
-        if self._pointer_test:
-            return pointer, new_offset
-        (value, _) = self.decode(pointer)
-        return value, new_offset
+        return pointer, new_offset
 
     def _decode_uint(self, size: int, offset: int) -> tuple[int, int]:
         new_offset = offset + size
@@ -155,6 +167,119 @@ class Decoder:
         (size, new_offset) = self._size_from_ctrl_byte(ctrl_byte, new_offset, type_num)
         return decoder(self, size, new_offset)
 
+    def decode_cached(self, offset: int) -> tuple[Record, int]:
+        """Decode the value at offset, using the record cache when enabled.
+
+        The values stored at an offset never change, and records as well as
+        pointer targets are shared by many networks, so they are kept in a
+        least recently used cache keyed by offset. Cached maps and arrays are
+        shared between callers and are therefore returned read-only (see
+        maxminddb.types.FrozenRecordDict and FrozenRecordList).
+
+        Arguments:
+            offset: the location of the data structure to decode
+
+        """
+        return self._cached(self._cache, offset, self.decode)
+
+    def decode_lazy(self, offset: int) -> tuple[Record, int]:
+        """Decode the value at offset, deferring the decoding of map values.
+
+        A map is returned as a LazyRecordDict: its keys are decoded and its
+        values skipped over, then decoded on first access. Other values are
+        decoded as by decode_cached. Lazy maps use their own record cache,
+        so the values decoded by previous lookups are reused.
+
+        Arguments:
+            offset: the location of the data structure to decode
+
+        """
+        return self._cached(self._lazy_cache, offset, self._decode_lazy)
+
+    def _decode_lazy(self, offset: int) -> tuple[Record, int]:
+        ctrl_byte = self._buffer[offset]
+        type_num = ctrl_byte >> 5
+        if type_num == 1:
+            (size, new_offset) = self._size_from_ctrl_byte(
+                ctrl_byte, offset + 1, type_num
+            )
+            (pointer, new_offset) = self._read_pointer(size, new_offset)
+            (value, _) = self.decode_lazy(pointer)
+            return value, new_offset
+        if type_num != 7:
+            return self.decode_cached(offset)
+
+        (size, new_offset) = self._size_from_ctrl_byte(ctrl_byte, offset + 1, 7)
+        offsets = {}
+        for _ in range(size):
+            (key, new_offset) = self.decode(new_offset)
+            offsets[cast("str", key)] = new_offset
+            new_offset = self._skip(new_offset)
+        return LazyRecordDict(self.decode, offsets), new_offset
+
+    def _skip(self, offset: int) -> int:
+        """Return the offset following the value at offset, without decoding it."""
+        ctrl_byte = self._buffer[offset]
+        type_num = ctrl_byte >> 5
+        new_offset = offset + 1
+        if not type_num:
+            (type_num, new_offset) = self._read_extended(new_offset)
+        if type_num not in self._type_decoder:
+            msg = f"Unexpected type number ({type_num}) encountered"
+            raise InvalidDatabaseError(msg)
+
+        (size, new_offset) = self._size_from_ctrl_byte(ctrl_byte, new_offset, type_num)
+        if type_num == 1:
+            return new_offset + (size >> 3) + 1
+        if type_num == 7:
+            size *= 2
+        if type_num in (7, 11):
+            for _ in range(size):
+                new_offset = self._skip(new_offset)
+            return new_offset
+        if type_num == 14:
+            return new_offset
+        return new_offset + size
+
+    def _cached(
+        self,
+        cache: OrderedDict[int, tuple[Record, int]],
+        offset: int,
+        decode: Callable[[int], tuple[Record, int]],
+    ) -> tuple[Record, int]:
+        if not self._cache_size:
+            return decode(offset)
+
+        cached = cache.get(offset)
+        if cached is not None:
+            self.cache_hits += 1
+            try:
+                cache.move_to_end(offset)
+            except KeyError:
+                # evicted by another thread in the meantime
+                pass
+            return cached
+
+        self.cache_misses += 1
+        (value, new_offset) = decode(offset)
+        cached = (freeze(value), new_offset)
+        cache[offset] = cached
+        while len(cache) > self._cache_size:
+            try:
+                cache.popitem(last=False)
+            except KeyError:
+                break
+        return cached
+
+    def cache_info(self) -> dict[str, int]:
+        """Return the hits, misses and size of the record cache."""
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "size": len(self._cache) + len(self._lazy_cache),
+            "max_size": self._cache_size,
+        }
+
     def _read_extended(self, offset: int) -> tuple[int, int]:
         next_byte = self._buffer[offset]
         type_num = next_byte + 7
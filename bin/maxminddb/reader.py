@@ -19,7 +19,7 @@ from maxminddb.errors import InvalidDatabaseError
 from maxminddb.file import FileBuffer
 
 if TYPE_CHECKING:
-    from collections.abc import Iterator
+    from collections.abc import Callable, Iterator
     from os import PathLike
 
     from typing_extensions import Self
@@ -28,6 +28,121 @@ if TYPE_CHECKING:
 
 _IPV4_MAX_NUM = 2**32
 
+_UINT32 = struct.Struct(b"!I")
+_UINT24 = struct.Struct(b"!BH")
+
+
+def _make_tree_readers(  # noqa: C901
+    buffer: bytes | FileBuffer | "mmap.mmap",  # noqa: UP037
+    record_size: int,
+    node_count: int,
+) -> tuple[Callable[[int, int], int], Callable[[int, int, int], tuple[int, int]]]:
+    """Return the node reader and the tree walk specialised for record_size.
+
+    ``read_node(node, index)`` returns the left (0) or right (1) record of a
+    node. ``walk(node, ip_int, bit_count)`` follows the bits of ip_int from
+    node and returns the record it ends on along with the number of bits
+    consumed. Records are read straight from the buffer with
+    ``Struct.unpack_from``; a FileBuffer, which only supports slicing, uses
+    the generic readers.
+    """
+    if isinstance(buffer, FileBuffer):
+
+        def read_node(node_number: int, index: int) -> int:
+            return _read_node_from_slices(buffer, record_size, node_number, index)
+
+        def walk(node: int, ip_int: int, bit_count: int) -> tuple[int, int]:
+            i = bit_count
+            while i and node < node_count:
+                i -= 1
+                node = read_node(node, (ip_int >> i) & 1)
+            return node, bit_count - i
+
+        return read_node, walk
+
+    if record_size == 24:
+        unpack_24 = _UINT24.unpack_from
+
+        def read_node(node_number: int, index: int) -> int:
+            (high, low) = unpack_24(buffer, node_number * 6 + index * 3)
+            return high << 16 | low
+
+        def walk(node: int, ip_int: int, bit_count: int) -> tuple[int, int]:
+            i = bit_count
+            while i and node < node_count:
+                i -= 1
+                (high, low) = unpack_24(buffer, node * 6 + ((ip_int >> i) & 1) * 3)
+                node = high << 16 | low
+            return node, bit_count - i
+
+    elif record_size == 28:
+        unpack_32 = _UINT32.unpack_from
+
+        # The middle byte holds the 4 high bits of the left record in its high
+        # nibble and those of the right record in its low nibble.
+        def read_node(node_number: int, index: int) -> int:
+            if index:
+                return unpack_32(buffer, node_number * 7 + 3)[0] & 0x0FFFFFFF
+            value = unpack_32(buffer, node_number * 7)[0]
+            return (value & 0xF0) << 20 | value >> 8
+
+        def walk(node: int, ip_int: int, bit_count: int) -> tuple[int, int]:
+            i = bit_count
+            while i and node < node_count:
+                i -= 1
+                if (ip_int >> i) & 1:
+                    node = unpack_32(buffer, node * 7 + 3)[0] & 0x0FFFFFFF
+                else:
+                    value = unpack_32(buffer, node * 7)[0]
+                    node = (value & 0xF0) << 20 | value >> 8
+            return node, bit_count - i
+
+    elif record_size == 32:
+        unpack_32 = _UINT32.unpack_from
+
+        def read_node(node_number: int, index: int) -> int:
+            return unpack_32(buffer, node_number * 8 + index * 4)[0]
+
+        def walk(node: int, ip_int: int, bit_count: int) -> tuple[int, int]:
+            i = bit_count
+            while i and node < node_count:
+                i -= 1
+                node = unpack_32(buffer, node * 8 + ((ip_int >> i) & 1) * 4)[0]
+            return node, bit_count - i
+
+    else:
+        msg = f"Unknown record size: {record_size}"
+        raise InvalidDatabaseError(msg)
+
+    return read_node, walk
+
+
+def _read_node_from_slices(
+    buffer: FileBuffer,
+    record_size: int,
+    node_number: int,
+    index: int,
+) -> int:
+    base_offset = node_number * record_size // 4
+    if record_size == 24:
+        offset = base_offset + index * 3
+        node_bytes = b"\x00" + buffer[offset : offset + 3]
+    elif record_size == 28:
+        offset = base_offset + 3 * index
+        node_bytes = bytearray(buffer[offset : offset + 4])
+        if index:
+            node_bytes[0] = 0x0F & node_bytes[0]
+        else:
+            middle = (0xF0 & node_bytes.pop()) >> 4
+            node_bytes.insert(0, middle)
+    elif record_size == 32:
+        offset = base_offset + index * 4
+        node_bytes = buffer[offset : offset + 4]
+    else:
+        msg = f"Unknown record size: {record_size}"
+        raise InvalidDatabaseError(msg)
+    return _UINT32.unpack(node_bytes)[0]
+
 
 class Reader:
     """A pure Python implementation of a reader for the MaxMind DB format.
@@ -44,11 +159,14 @@ class Reader:
     _decoder: Decoder
     _metadata: Metadata
     _ipv4_start: int
+    _read_node: Callable[[int, int], int]
+    _walk: Callable[[int, int, int], tuple[int, int]]
 
     def __init__(
         self,
         database: AnyStr | int | PathLike | IO,
         mode: int = MODE_AUTO,
+        cache_size: int = 0,
     ) -> None:
         """Reader for the MaxMind DB file format.
 
@@ -62,6 +180,9 @@ class Reader:
                   * MODE_AUTO - tries MODE_MMAP and then MODE_FILE. Default.
                   * MODE_FD - the param passed via database is a file descriptor, not
                               a path. This mode implies MODE_MEMORY.
+            cache_size: number of decoded records kept in memory, 0 (default)
+                        disables the record cache. Records served from the
+                        cache are read-only.
 
         """
         filename: Any
@@ -124,9 +245,17 @@ class Reader:
         self._decoder = Decoder(
             self._buffer,
             self._metadata.search_tree_size + self._DATA_SECTION_SEPARATOR_SIZE,
+            cache_size=cache_size,
         )
         self.closed = False
 
+        # selected once, as they run for every bit of every lookup
+        self._read_node, self._walk = _make_tree_readers(
+            self._buffer,
+            self._metadata.record_size,
+            self._metadata.node_count,
+        )
+
         ipv4_start = 0
         if self._metadata.ip_version == 6:
             # We store the IPv4 starting node as an optimization for IPv4 lookups
@@ -157,11 +286,14 @@ class Reader:
     def get_with_prefix_len(
         self,
         ip_address: str | IPv6Address | IPv4Address,
+        lazy: bool = False,  # noqa: FBT001, FBT002
     ) -> tuple[Record | None, int]:
         """Return a tuple with the record and the associated prefix length.
 
         Arguments:
             ip_address: an IP address in the standard string notation
+            lazy: decode the values of a map record on first access, see
+                  Decoder.decode_lazy
 
         """
         if isinstance(ip_address, str):
@@ -170,24 +302,42 @@ class Reader:
             address = ip_address
 
         try:
-            packed_address = bytearray(address.packed)
+            version = address.version
+            ip_int = int(address)
         except AttributeError as ex:
             msg = "argument 1 must be a string or ipaddress object"
             raise TypeError(msg) from ex
 
-        if address.version == 6 and self._metadata.ip_version == 4:
+        return self.get_int_with_prefix_len(ip_int, version, lazy)
+
+    def get_int_with_prefix_len(
+        self,
+        ip_int: int,
+        version: int,
+        lazy: bool = False,  # noqa: FBT001, FBT002
+    ) -> tuple[Record | None, int]:
+        """Same as get_with_prefix_len for an IP address given as an integer.
+
+        Arguments:
+            ip_int: the IP address as an integer, e.g. int(IPv4Address(...))
+            version: the version of the IP address, 4 or 6
+            lazy: see get_with_prefix_len
+
+        """
+        if version == 6 and self._metadata.ip_version == 4:
             msg = (
-                f"Error looking up {ip_address}. You attempted to look up "
-                "an IPv6 address in an IPv4-only database."
+                f"Error looking up {ipaddress.IPv6Address(ip_int)}. You attempted "
+                "to look up an IPv6 address in an IPv4-only database."
             )
             raise ValueError(
                 msg,
             )
 
-        (pointer, prefix_len) = self._find_address_in_tree(packed_address)
+        bit_count = 128 if version == 6 else 32
+        (pointer, prefix_len) = self._find_int_in_tree(ip_int, bit_count)
 
         if pointer:
-            return self._resolve_data_pointer(pointer), prefix_len
+            return self._resolve_data_pointer(pointer, lazy), prefix_len
         return None, prefix_len
 
     def __iter__(self) -> Iterator:
@@ -219,15 +369,11 @@ class Reader:
             yield from self._generate_children(right, depth, ip_acc | 1)
 
     def _find_address_in_tree(self, packed: bytearray) -> tuple[int, int]:
-        bit_count = len(packed) * 8
-        node = self._start_node(bit_count)
-        node_count = self._metadata.node_count
+        return self._find_int_in_tree(int.from_bytes(packed, "big"), len(packed) * 8)
 
-        i = 0
-        while i < bit_count and node < node_count:
-            bit = 1 & (packed[i >> 3] >> 7 - (i % 8))
-            node = self._read_node(node, bit)
-            i = i + 1
+    def _find_int_in_tree(self, ip_int: int, bit_count: int) -> tuple[int, int]:
+        node_count = self._metadata.node_count
+        (node, i) = self._walk(self._start_node(bit_count), ip_int, bit_count)
 
         if node == node_count:
             # Record is empty
@@ -243,39 +389,27 @@ class Reader:
             return self._ipv4_start
         return 0
 
-    def _read_node(self, node_number: int, index: int) -> int:
-        base_offset = node_number * self._metadata.node_byte_size
-
-        record_size = self._metadata.record_size
-        if record_size == 24:
-            offset = base_offset + index * 3
-            node_bytes = b"\x00" + self._buffer[offset : offset + 3]
-        elif record_size == 28:
-            offset = base_offset + 3 * index
-            node_bytes = bytearray(self._buffer[offset : offset + 4])
-            if index:
-                node_bytes[0] = 0x0F & node_bytes[0]
-            else:
-                middle = (0xF0 & node_bytes.pop()) >> 4
-                node_bytes.insert(0, middle)
-        elif record_size == 32:
-            offset = base_offset + index * 4
-            node_bytes = self._buffer[offset : offset + 4]
-        else:
-            msg = f"Unknown record size: {record_size}"
-            raise InvalidDatabaseError(msg)
-        return struct.unpack(b"!I", node_bytes)[0]
-
-    def _resolve_data_pointer(self, pointer: int) -> Record:
+    def _resolve_data_pointer(
+        self,
+        pointer: int,
+        lazy: bool = False,  # noqa: FBT001, FBT002
+    ) -> Record:
         resolved = pointer - self._metadata.node_count + self._metadata.search_tree_size
 
         if resolved >= self._buffer_size:
             msg = "The MaxMind DB file's search tree is corrupt"
             raise InvalidDatabaseError(msg)
 
-        (data, _) = self._decoder.decode(resolved)
+        if lazy:
+            (data, _) = self._decoder.decode_lazy(resolved)
+        else:
+            (data, _) = self._decoder.decode_cached(resolved)
         return data
 
+    def cache_info(self) -> dict[str, int]:
+        """Return the hits, misses and size of the record cache."""
+        return self._decoder.cache_info()
+
     def close(self) -> None:
         """Close the MaxMind DB file and returns the resources to the system."""
         with contextlib.suppress(AttributeError):
@@ -1,5 +1,6 @@
 """Types representing database records."""
 
+from collections.abc import Callable, Iterator, Mapping
 from typing import AnyStr, Union
 
 Primitive = Union[AnyStr, bool, float, int]
@@ -12,3 +13,114 @@ class RecordList(list[Record]):
 
 class RecordDict(dict[str, Record]):
     """RecordDict is a type for dicts in a database record."""
+
+
+def _read_only(self, *_args, **_kwargs) -> None:  # noqa: ANN002, ANN003
+    msg = f"{type(self).__name__} is read-only, copy it before modifying it"
+    raise TypeError(msg)
+
+
+class FrozenRecordList(RecordList):
+    """Read-only RecordList, shared by the lookups served from the record cache.
+
+    ``list(value)`` or ``copy.deepcopy(value)`` returns a modifiable copy.
+    """
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __copy__(self) -> list:
+        return list(self)
+
+    def __deepcopy__(self, memo: dict) -> list:
+        from copy import deepcopy
+
+        return [deepcopy(value, memo) for value in self]
+
+    def __reduce__(self) -> tuple:
+        return list, (list(self),)
+
+
+class FrozenRecordDict(RecordDict):
+    """Read-only RecordDict, shared by the lookups served from the record cache.
+
+    ``dict(value)`` or ``copy.deepcopy(value)`` returns a modifiable copy.
+    """
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    pop = popitem = setdefault = update = clear = _read_only
+
+    def __copy__(self) -> dict:
+        return dict(self)
+
+    def __deepcopy__(self, memo: dict) -> dict:
+        from copy import deepcopy
+
+        return {key: deepcopy(value, memo) for key, value in self.items()}
+
+    def __reduce__(self) -> tuple:
+        return dict, (dict(self),)
+
+
+class LazyRecordDict(Mapping):
+    """Read-only map of a database record whose values are decoded on access.
+
+    Only the keys are decoded upfront, along with the offset of their value,
+    so reading a few fields of a large record skips decoding the others.
+    Decoded values are kept and returned read-only (see freeze).
+    ``dict(value)`` decodes every value and returns a modifiable copy.
+    """
+
+    __slots__ = ("_decode", "_offsets", "_values")
+
+    def __init__(
+        self,
+        decode: Callable[[int], tuple[Record, int]],
+        offsets: dict[str, int],
+    ) -> None:
+        self._decode = decode
+        self._offsets = offsets
+        self._values: dict[str, Record] = {}
+
+    def __getitem__(self, key: str) -> Record:
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        (value, _) = self._decode(self._offsets[key])
+        value = self._values[key] = freeze(value)
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._offsets
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._offsets)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({dict(self)!r})"
+
+    def __copy__(self) -> dict:
+        return dict(self)
+
+    def __deepcopy__(self, memo: dict) -> dict:
+        from copy import deepcopy
+
+        return {key: deepcopy(value, memo) for key, value in self.items()}
+
+    def __reduce__(self) -> tuple:
+        return dict, (dict(self),)
+
+
+def freeze(value: Record) -> Record:
+    """Return a read-only version of a decoded value."""
+    if isinstance(value, (FrozenRecordDict, FrozenRecordList, LazyRecordDict)):
+        return value
+    if isinstance(value, dict):
+        return FrozenRecordDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return FrozenRecordList(freeze(item) for item in value)
+    return value